@@ -12,34 +12,39 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 try:
     from models.model_manager import ModelManager
     from components.detective_ai import DetectiveAI
+    from components.chat_interface import ChatInterface
+    from utils.chat_log import ChatLog
     from utils.document_system import Document
 except ImportError as e:
     st.error(f"Import error: {e}")
     st.error("Please ensure all required modules are available")
     st.stop()
 
-def process_user_input(user_input):
-    """Process user input and get AI response"""
-    try:
-        # Add user message to chat history
-        st.session_state.chat_history.append({"role": "user", "content": user_input})
+chat_interface = ChatInterface()
 
-        # Get AI response
-        with st.spinner("Detective Marco is thinking..."):
-            ai_response, discoveries = st.session_state.detective_ai.respond(user_input)
-            
-            # Add AI response to chat history with any discoveries
-            message = {
-                "role": "assistant", 
-                "content": ai_response
-            }
-            if discoveries:
-                message["discoveries"] = discoveries
-            st.session_state.chat_history.append(message)
 
-    except Exception as e:
-        st.error(f"Error processing input: {e}")
-        st.error(f"Traceback: {traceback.format_exc()}")
+def stream_assistant_turn(user_input):
+    """Render Detective Marco's reply as it is generated and record the exchange"""
+    # Add user message to chat - Undo takes the log back to here, however much of the turn gets written
+    st.session_state.chat_log.start_turn()
+    st.session_state.chat_log.append("user", user_input)
+    with st.chat_message("user", avatar=ChatInterface.USER_AVATAR):
+        st.write(user_input)
+
+    # Stream AI response - discovery announcements arrive first, then the model's text
+    with st.chat_message("assistant", avatar=ChatInterface.AI_AVATAR):
+        stream, discoveries = st.session_state.detective_ai.respond_stream(user_input)
+        st.write_stream(stream)
+        # Clues Marco mentioned while streaming have been appended to discoveries by now
+        response = st.session_state.detective_ai.last_response
+        if discoveries:
+            for doc in discoveries:
+                st.info(f"🔍 New clue discovered: {doc.title}")
+
+    # Add assistant response to chat - only the ids of its discoveries are kept
+    st.session_state.chat_log.append("assistant", response, [doc.id for doc in discoveries])
+
+    st.session_state.chat_count += 1
 
 
 def main():
@@ -59,16 +64,12 @@ def main():
         st.session_state.model_manager = None
     if 'case_initialized' not in st.session_state:
         st.session_state.case_initialized = False
-    if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
-    if 'discovered_documents' not in st.session_state:
-        st.session_state.discovered_documents = []
     if 'chat_count' not in st.session_state:
         st.session_state.chat_count = 0
     if 'case_solved' not in st.session_state:
         st.session_state.case_solved = False
-    if 'messages' not in st.session_state:
-        st.session_state.messages = []
+    if 'chat_log' not in st.session_state:
+        st.session_state.chat_log = ChatLog()  # Latest messages in memory, older ones spilled to disk
 
     # Sidebar for game controls
     with st.sidebar:
@@ -79,8 +80,14 @@ def main():
         if st.button("Load TinyLLaMA Model"):
             with st.spinner("Loading model..."):
                 try:
-                    st.session_state.model_manager = ModelManager()
-                    st.session_state.model_manager.load_model(use_lora=True)
+                    # The weights are shared process-wide; a session only holds a reference
+                    model_manager = ModelManager().load_model(use_lora=True)
+                    if st.session_state.model_manager:
+                        st.session_state.model_manager.release()
+                    st.session_state.model_manager = model_manager
+                    # A case in progress carries on with the reloaded model
+                    if st.session_state.detective_ai:
+                        st.session_state.detective_ai.use_model_manager(model_manager)
                     st.success("Model loaded successfully!")
                 except Exception as e:
                     st.error(f"Error loading model: {e}")
@@ -105,9 +112,8 @@ def main():
                     st.session_state.detective_ai = DetectiveAI(st.session_state.model_manager)
                     st.session_state.detective_ai.initialize_case(selected_case)
                     st.session_state.case_initialized = True
-                    st.session_state.chat_history = []
-                    st.session_state.messages = []  # Reset chat messages
-                    st.session_state.discovered_documents = []
+                    st.session_state.chat_log.clear()  # Reset chat messages
+                    chat_interface.reset_window()
                     st.session_state.chat_count = 0
                     st.session_state.case_solved = False
                     st.success(f"Case '{case_options[selected_case]}' initialized!")
@@ -147,8 +153,7 @@ def main():
                                 importance=5,
                                 discovery_message="You've solved the case! 🎉"
                             )
-                            st.session_state.detective_ai.document_manager.add_document(solution_doc)
-                            st.session_state.detective_ai.document_manager.discovered_docs.add("solution")
+                            st.session_state.detective_ai.document_manager.discover_document(solution_doc)
                         else:
                             st.error("That's not quite right. Keep investigating!")
                 
@@ -160,12 +165,13 @@ def main():
                 st.error(f"Error getting case summary: {e}")
 
             # Reset buttons
-            col1, col2 = st.columns(2)
+            col1, col2, col3 = st.columns(3)
             with col1:
                 if st.button("Reset Chat"):
                     try:
                         st.session_state.detective_ai.reset_conversation()
-                        st.session_state.chat_history = []
+                        st.session_state.chat_log.clear()
+                        chat_interface.reset_window()
                         st.session_state.chat_count = 0
                         st.rerun()
                     except Exception as e:
@@ -175,14 +181,25 @@ def main():
                 if st.button("Reset Case"):
                     try:
                         st.session_state.detective_ai.reset_case()
-                        st.session_state.chat_history = []
-                        st.session_state.discovered_documents = []
+                        st.session_state.chat_log.clear()
+                        chat_interface.reset_window()
                         st.session_state.chat_count = 0
                         st.session_state.case_solved = False
                         st.rerun()
                     except Exception as e:
                         st.error(f"Error resetting case: {e}")
 
+            with col3:
+                if st.button("Undo"):
+                    try:
+                        # Takes back the last question along with the clues it uncovered
+                        if st.session_state.detective_ai.undo_last_turn():
+                            st.session_state.chat_log.undo_turn()
+                            st.session_state.chat_count = max(st.session_state.chat_count - 1, 0)
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Error undoing last question: {e}")
+
             # Suggested questions
             st.subheader("💡 Suggested Questions")
             try:
@@ -200,71 +217,20 @@ def main():
         try:
             st.header(f"🔍 Case: {st.session_state.detective_ai.current_case}")
 
-            # Initialize chat messages if empty
-            if not st.session_state.messages:
-                st.session_state.messages = []
-
-            # Display chat messages
-            for message in st.session_state.messages:
-                with st.chat_message(message["role"]):
-                    st.write(message["content"])
-                    if message["role"] == "assistant" and "discoveries" in message:
-                        for doc in message["discoveries"]:
-                            st.info(f"🔍 New clue discovered: {doc.title}")
+            # Display the latest chat messages - older ones behind "Load earlier"
+            chat_interface.render_chat(st.session_state.chat_log, st.session_state.detective_ai.get_document)
 
 # adding to revive suggested questions
             # Handle pending input from suggestion buttons
             pending_input = st.session_state.get('pending_input', None)
             if pending_input:
                 st.session_state.pending_input = None
-                # Add user message to chat
-                st.session_state.messages.append({"role": "user", "content": pending_input})
-                with st.chat_message("user"):
-                    st.write(pending_input)
-
-                # Get AI response
-                with st.chat_message("assistant"):
-                    with st.spinner("Detective Marco is thinking..."):
-                        response, discoveries = st.session_state.detective_ai.respond(pending_input)
-                        st.write(response)
-                        if discoveries:
-                            for doc in discoveries:
-                                st.info(f"🔍 New clue discovered: {doc.title}")
-                
-                # Add assistant response to chat
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response,
-                    "discoveries": discoveries
-                })
-                
-                st.session_state.chat_count += 1
+                stream_assistant_turn(pending_input)
                 st.rerun()
 # end addition
             # Chat input
             if prompt := st.chat_input("Ask Detective Marco a question or share your thoughts..."):
-                # Add user message to chat
-                st.session_state.messages.append({"role": "user", "content": prompt})
-                with st.chat_message("user"):
-                    st.write(prompt)
-
-                # Get AI response
-                with st.chat_message("assistant"):
-                    with st.spinner("Detective Marco is thinking..."):
-                        response, discoveries = st.session_state.detective_ai.respond(prompt)
-                        st.write(response)
-                        if discoveries:
-                            for doc in discoveries:
-                                st.info(f"🔍 New clue discovered: {doc.title}")
-                
-                # Add assistant response to chat
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response,
-                    "discoveries": discoveries
-                })
-                
-                st.session_state.chat_count += 1
+                stream_assistant_turn(prompt)
 
             # Display discovered documents
             st.write("---")
@@ -285,12 +251,9 @@ def main():
                     # Add debug info
                     st.write(f"Total discovered documents: {len(discovered_docs)}")
                     
-                    # Display all documents in a scrollable container
+                    # Display all documents in a scrollable container - one block, built once per discovery
                     with st.container():
-                        for doc in discovered_docs:
-                            st.write(f"**{doc.title}** ({doc.category})")
-                            st.write(doc.content)
-                            st.write("---")
+                        st.markdown(st.session_state.detective_ai.get_discovered_clues_markdown())
 
         except Exception as e:
             st.error(f"Error in main interface: {e}")
@@ -0,0 +1,63 @@
+"""
+Benchmark: aggregate tokens/s for concurrent simulated players, with and without request batching
+
+Every player is a thread with its own ModelManager (sharing the weights via
+the registry) that sends its turns back to back.
+
+    python -m benchmarks.batching --turns 2 --new-tokens 48
+"""
+import argparse
+import threading
+import time
+
+from benchmarks.common import SEASIDE_QUESTIONS, load_model_manager
+from components.detective_ai import DetectiveAI
+
+
+def run_players(managers, prompts, turns, new_tokens):
+    """Let every player send `turns` prompts concurrently; returns (generated tokens, seconds)"""
+    generated = []
+    lock = threading.Lock()
+
+    def play(player, model_manager):
+        for turn in range(turns):
+            prompt = prompts[(player + turn) % len(prompts)]
+            model_manager.generate_response(prompt, max_length=new_tokens)
+            with lock:
+                generated.append(model_manager.last_generation_stats["generated_tokens"])
+
+    threads = [threading.Thread(target=play, args=(player, manager)) for player, manager in enumerate(managers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(generated), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=2, help="Turns per player")
+    parser.add_argument("--new-tokens", type=int, default=48, help="Tokens generated per turn")
+    parser.add_argument("--players", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    managers = [load_model_manager() for _ in range(max(args.players))]
+    detective = DetectiveAI(managers[0])
+    detective.initialize_case("seaside_cottage")
+    prompts = []
+    for question in SEASIDE_QUESTIONS:
+        _, rag_context = detective.document_manager.process_input(question)
+        prompts.append(detective._build_prompt(question, rag_context))
+
+    for batching in (False, True):
+        managers[0].set_batching(batching)
+        for players in args.players:
+            tokens, seconds = run_players(managers[:players], prompts, args.turns, args.new_tokens)
+            print(f"{'batched' if batching else 'serial':>7} | {players:2d} players: "
+                  f"{tokens / seconds:7.1f} tokens/s aggregate ({tokens} tokens in {seconds:.1f} s)")
+    managers[0].set_batching(False)
+
+
+if __name__ == "__main__":
+    main()
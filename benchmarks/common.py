@@ -0,0 +1,33 @@
+"""
+Shared helpers for the benchmark scripts - run them from the repo root with `python -m benchmarks.<name>`
+"""
+import time
+
+# A scripted seaside_cottage playthrough - each line is one player turn
+SEASIDE_QUESTIONS = [
+    "Who were the guests at the cottage last night?",
+    "Let's begin by speaking with Lady Agatha...",
+    "Did she see who delivered the milk? Was there a cart on the road?",
+    "What about the Sailors? Maeve and Eliot went to the lighthouse.",
+    "Let's ask Maeve again - was she at the beach with Clara?",
+    "We should talk to Captain Griggs about the fog.",
+    "Look at Delilah's notes in her book.",
+    "Who signed the receipt for the cleaning supplies? It says H.",
+    "Let's go up to the attic and look at the footprint in the dust.",
+    "Could Hugo the old groundskeeper have been in the attic?",
+]
+
+
+def load_model_manager(**load_kwargs):
+    """Load the game's model the same way app.py does"""
+    from models.model_manager import ModelManager
+
+    load_kwargs.setdefault("use_lora", True)
+    return ModelManager().load_model(**load_kwargs)
+
+
+def timed(fn, *args, **kwargs):
+    """Run fn and return (result, elapsed seconds)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
@@ -0,0 +1,70 @@
+"""
+Benchmark: token-overlap vs dense (model input embedding) vs BM25 retrieval on seaside_cottage
+
+Every case document is indexed, then each scripted question is checked against
+the documents a player asking it is after. Reports index build time (cold, and
+warm from the on-disk embedding cache), query latency, recall@k and MRR.
+
+    python -m benchmarks.dense_retrieval --top-k 3
+"""
+import argparse
+import tempfile
+import time
+
+import config
+from benchmarks.common import SEASIDE_QUESTIONS, load_model_manager, timed
+from data.case_manager import CaseDocumentManager
+from utils.document_system import RAGSystem
+
+# Documents that answer each scripted question (same order as SEASIDE_QUESTIONS)
+RELEVANT_DOCUMENTS = [
+    {"guest_list"},
+    {"agatha_interview", "agatha_followup_1"},
+    {"agatha_followup_1"},
+    {"maeve_interview", "griggs_interview"},
+    {"maeve_followup_1"},
+    {"griggs_interview"},
+    {"delilahs_notes"},
+    {"cleaning_receipt"},
+    {"footprint_report"},
+    {"agatha_followup_1", "cleaning_receipt", "footprint_report"},
+]
+
+
+def evaluate(rag, top_k):
+    """(recall@k, MRR, mean ms/query) over the labeled questions"""
+    hits, reciprocal_ranks, elapsed = 0, 0.0, 0.0
+    for question, relevant in zip(SEASIDE_QUESTIONS, RELEVANT_DOCUMENTS):
+        results, seconds = timed(rag.retrieve_relevant_documents, question, top_k)
+        elapsed += seconds
+        ranked = [doc.id for doc, _ in results]
+        if relevant & set(ranked):
+            hits += 1
+            reciprocal_ranks += 1 / (1 + min(ranked.index(doc_id) for doc_id in relevant & set(ranked)))
+    count = len(SEASIDE_QUESTIONS)
+    return hits / count, reciprocal_ranks / count, elapsed * 1000 / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    # Start from an empty embedding cache so the cold build really computes every vector
+    config.RAG_EMBEDDING_CACHE_DIR = tempfile.mkdtemp(prefix="rag_embeddings_")
+
+    model_manager = load_model_manager()
+    documents = list(CaseDocumentManager("seaside_cottage").discovery_system.documents.values())
+
+    modes = (("tokens", "token overlap"), ("bm25", "BM25"), ("dense", "dense, cold cache"), ("dense", "dense, warm cache"))
+    for mode, label in modes:
+        rag = RAGSystem(input_embeddings=model_manager.input_embeddings(), retrieval_mode=mode,
+                        tokenizer=model_manager.tokenizer)
+        _, build_seconds = timed(rag.add_documents, documents)
+        recall, mrr, query_ms = evaluate(rag, args.top_k)
+        print(f"{label:18s} build {build_seconds * 1000:7.1f} ms, query {query_ms:.3f} ms, "
+              f"recall@{args.top_k} {recall:.2f}, MRR {mrr:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark: per-turn keyword discovery, one substring search per keyword vs the Aho-Corasick automaton
+
+A synthetic case spreads --keywords random keywords (single words and short
+phrases) over --docs documents; the seaside_cottage questions, with some of
+the keywords mixed in, are the player turns. Needs no model or tokenizer. Both
+approaches are checked to trigger the same documents.
+
+    python -m benchmarks.keyword_discovery --keywords 10000
+"""
+import argparse
+import random
+import string
+import time
+
+from benchmarks.common import SEASIDE_QUESTIONS
+from utils.keyword_matcher import KeywordAutomaton
+
+
+def random_word(rng):
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10)))
+
+
+def synthetic_keyword_map(num_keywords, num_docs, seed=0):
+    """keyword -> document ids, like DocumentDiscoverySystem.keyword_map"""
+    rng = random.Random(seed)
+    keyword_map = {}
+    while len(keyword_map) < num_keywords:
+        keyword = " ".join(random_word(rng) for _ in range(rng.choice((1, 1, 1, 2, 3))))
+        keyword_map.setdefault(keyword, []).append(f"doc_{rng.randrange(num_docs)}")
+    return keyword_map
+
+
+def substring_discovery(keyword_map, text):
+    """The previous check_for_discoveries loop"""
+    return [doc_id for keyword, doc_ids in keyword_map.items() if keyword in text for doc_id in doc_ids]
+
+
+def automaton_discovery(automaton, keyword_map, text):
+    return [doc_id for index in sorted(automaton.find(text)) for doc_id in keyword_map[automaton.keywords[index]]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keywords", type=int, default=10000)
+    parser.add_argument("--docs", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=20, help="Passes over the turns")
+    args = parser.parse_args()
+
+    keyword_map = synthetic_keyword_map(args.keywords, args.docs)
+    rng = random.Random(1)
+    turns = [
+        f"{question} {' '.join(rng.sample(list(keyword_map), 2))}".lower() if i % 2 else question.lower()
+        for i, question in enumerate(SEASIDE_QUESTIONS)
+    ]
+
+    start = time.perf_counter()
+    automaton = KeywordAutomaton(list(keyword_map))
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    for text in turns:
+        assert substring_discovery(keyword_map, text) == automaton_discovery(automaton, keyword_map, text), text
+
+    timings = {}
+    for name, discover in (("substring", lambda text: substring_discovery(keyword_map, text)),
+                           ("automaton", lambda text: automaton_discovery(automaton, keyword_map, text))):
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            for text in turns:
+                discover(text)
+        timings[name] = (time.perf_counter() - start) * 1000 / (args.repeats * len(turns))
+
+    print(f"{len(keyword_map)} keywords over {args.docs} docs, automaton compiled once in {compile_ms:.0f} ms")
+    print(f"per turn: substring {timings['substring']:.3f} ms, automaton {timings['automaton']:.3f} ms "
+          f"({timings['substring'] / timings['automaton']:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Micro-benchmark: per-step cost of transformers' NoRepeatNGramLogitsProcessor vs NoRepeatNGramProcessor
+
+Needs no model - random token ids stand in for prompts of each length. Both
+processors are also checked to ban exactly the same tokens.
+
+    python -m benchmarks.no_repeat_ngram --steps 200
+"""
+import argparse
+import time
+
+import torch
+from transformers import NoRepeatNGramLogitsProcessor
+
+from models.generation import NoRepeatNGramProcessor
+
+VOCAB_SIZE = 32000
+
+
+def per_step_ms(processor, input_ids, scores, steps):
+    """Mean milliseconds per call over `steps` calls"""
+    start = time.perf_counter()
+    for _ in range(steps):
+        processor(input_ids, scores.clone())
+    return (time.perf_counter() - start) * 1000 / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=200, help="Calls timed per prompt length")
+    parser.add_argument("--ngram", type=int, default=2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for length in (256, 1024, 2048):
+        # A small effective vocabulary so repeated n-grams (and bans) actually occur
+        input_ids = torch.randint(0, 500, (1, length))
+        input_ids[0, -1] = input_ids[0, length // 2]
+        scores = torch.randn(1, VOCAB_SIZE)
+
+        stock = NoRepeatNGramLogitsProcessor(args.ngram)
+        tensor_based = NoRepeatNGramProcessor(args.ngram)
+        expected = torch.isinf(stock(input_ids, scores.clone()))
+        actual = torch.isinf(tensor_based(input_ids, scores.clone()))
+        assert torch.equal(expected, actual), "processors disagree on banned tokens"
+
+        stock_ms = per_step_ms(stock, input_ids, scores, args.steps)
+        tensor_ms = per_step_ms(tensor_based, input_ids, scores, args.steps)
+        print(f"{length:5d} tokens: stock {stock_ms:.3f} ms/step, tensor {tensor_ms:.3f} ms/step "
+              f"({stock_ms / tensor_ms:.1f}x), {int(expected.sum())} tokens banned")
+
+
+if __name__ == "__main__":
+    main()
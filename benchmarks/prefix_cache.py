@@ -0,0 +1,46 @@
+"""
+Benchmark: per-turn prefill time with and without the personality/case prefix cache
+
+Generates a single token per turn, so the timing is dominated by prefill.
+
+    python -m benchmarks.prefix_cache --runs 3
+"""
+import argparse
+import statistics
+
+from benchmarks.common import SEASIDE_QUESTIONS, load_model_manager, timed
+from components.detective_ai import DetectiveAI
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=3, help="Repetitions per prompt")
+    args = parser.parse_args()
+
+    model_manager = load_model_manager()
+    detective = DetectiveAI(model_manager)
+    detective.initialize_case("seaside_cottage")
+
+    prompts = []
+    for question in SEASIDE_QUESTIONS:
+        _, rag_context = detective.document_manager.process_input(question)
+        prompts.append(detective._build_prompt(question, rag_context))
+
+    _, build_time = timed(model_manager.build_prefix_cache, detective._build_prompt_prefix())
+    print(f"Prefix: {len(detective.prefix_cache)} tokens, built in {build_time * 1000:.1f} ms")
+
+    for label, prefix_cache in (("no cache", None), ("prefix cache", detective.prefix_cache)):
+        times = []
+        for prompt in prompts:
+            for _ in range(args.runs):
+                _, elapsed = timed(
+                    model_manager.generate_response,
+                    prompt, max_length=1, prefix_cache=prefix_cache
+                )
+                times.append(elapsed)
+        print(f"{label:>13}: median {statistics.median(times) * 1000:.1f} ms/turn "
+              f"(mean {statistics.mean(times) * 1000:.1f} ms over {len(times)} turns)")
+
+
+if __name__ == "__main__":
+    main()
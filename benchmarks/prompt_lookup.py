@@ -0,0 +1,68 @@
+"""
+Benchmark: prompt-lookup speculative decoding on a scripted seaside_cottage playthrough
+
+Counts model forward passes per turn, so "tokens per step" is the number of
+tokens each forward pass produced (1.0 without speculation; higher means
+drafts copied from the evidence/conversation were accepted).
+
+Runs with the prompt's n-grams banned (config.NO_REPEAT_INCLUDE_PROMPT, the
+default) and allowed: the ban rejects most drafts, since they are copies of
+the prompt, so speculation only pays off with it off.
+
+    python -m benchmarks.prompt_lookup --draft-tokens 10
+"""
+import argparse
+import statistics
+import time
+
+import config
+from benchmarks.common import SEASIDE_QUESTIONS, load_model_manager
+from components.detective_ai import DetectiveAI
+
+
+def play(model_manager, forward_passes):
+    """Run the scripted playthrough; returns per-turn (generated tokens, forward passes, seconds)"""
+    detective = DetectiveAI(model_manager)
+    detective.initialize_case("seaside_cottage")
+
+    turns = []
+    for question in SEASIDE_QUESTIONS:
+        forward_passes[0] = 0
+        start = time.perf_counter()
+        detective.respond(question)
+        elapsed = time.perf_counter() - start
+        turns.append((model_manager.last_generation_stats.get("generated_tokens", 0), forward_passes[0], elapsed))
+    return turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--draft-tokens", type=int, default=10, help="prompt_lookup_num_tokens when enabled")
+    parser.add_argument("--ngram", type=int, default=3, help="max_matching_ngram_size when enabled")
+    args = parser.parse_args()
+
+    model_manager = load_model_manager()
+    forward_passes = [0]
+
+    def count_forward(*_):
+        forward_passes[0] += 1
+
+    # lm_head runs exactly once per forward pass, whether or not the model is wrapped by PEFT
+    model_manager.model.get_output_embeddings().register_forward_hook(count_forward)
+
+    config.PROMPT_LOOKUP_MAX_NGRAM = args.ngram
+    for include_prompt in (True, False):
+        config.NO_REPEAT_INCLUDE_PROMPT = include_prompt
+        for draft_tokens in (0, args.draft_tokens):
+            config.PROMPT_LOOKUP_NUM_TOKENS = draft_tokens
+            turns = play(model_manager, forward_passes)
+            tokens = sum(turn[0] for turn in turns)
+            passes = sum(turn[1] for turn in turns)
+            print(f"prompt n-grams {'banned' if include_prompt else 'allowed':>7} | draft tokens {draft_tokens:2d}: "
+                  f"{tokens / max(passes, 1):.2f} tokens per forward pass, "
+                  f"{statistics.mean(turn[1] for turn in turns):.1f} passes/turn, "
+                  f"{statistics.mean(turn[2] for turn in turns):.2f} s/turn")
+
+
+if __name__ == "__main__":
+    main()
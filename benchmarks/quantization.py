@@ -0,0 +1,92 @@
+"""
+Benchmark: fp32 vs dynamic int8 CPU inference on the seaside_cottage prompts
+
+Each mode runs in its own process so resident memory is measured cleanly.
+Decoding is greedy so the two modes' outputs can be compared token by token.
+
+    python -m benchmarks.quantization --new-tokens 64
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+
+from benchmarks.common import SEASIDE_QUESTIONS, load_model_manager, timed
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_worker(inference_mode: str, new_tokens: int):
+    """Generate greedily for every prompt and print the results as JSON"""
+    from components.detective_ai import DetectiveAI
+
+    model_manager = load_model_manager(inference_mode=inference_mode)
+    detective = DetectiveAI(model_manager)
+    detective.initialize_case("seaside_cottage")
+
+    outputs, total_tokens, total_seconds = [], 0, 0.0
+    for question in SEASIDE_QUESTIONS:
+        _, rag_context = detective.document_manager.process_input(question)
+        prompt = detective._build_prompt(question, rag_context)
+
+        inputs, generation_kwargs = model_manager._prepare_generation(prompt, new_tokens, temperature=1.0)
+        generation_kwargs.pop("temperature")
+        generation_kwargs["do_sample"] = False
+        sequence, elapsed = timed(model_manager._generate, inputs, generation_kwargs)
+
+        generated = sequence[0][len(inputs[0]):].tolist()
+        outputs.append(generated)
+        total_tokens += len(generated)
+        total_seconds += elapsed
+
+    print(json.dumps({
+        "tokens_per_second": total_tokens / total_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "outputs": outputs,
+    }))
+
+
+def agreement(reference, candidate) -> float:
+    """Share of reference tokens reproduced before the first divergence"""
+    matched = 0
+    for expected, actual in zip(reference, candidate):
+        if expected != actual:
+            break
+        matched += 1
+    return matched / max(len(reference), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--new-tokens", type=int, default=64, help="Greedy tokens generated per prompt")
+    parser.add_argument("--worker", choices=["fp32", "int8"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.new_tokens)
+        return
+
+    results = {}
+    for mode in ("fp32", "int8"):
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.quantization", "--worker", mode, "--new-tokens", str(args.new_tokens)],
+            check=True, capture_output=True, text=True
+        )
+        results[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"{mode}: {results[mode]['tokens_per_second']:.1f} tokens/s, "
+              f"peak RSS {results[mode]['peak_rss_mb']:.0f} MB")
+
+    prefixes = [agreement(ref, out) for ref, out in zip(results["fp32"]["outputs"], results["int8"]["outputs"])]
+    exact = sum(ref == out for ref, out in zip(results["fp32"]["outputs"], results["int8"]["outputs"]))
+    print(f"int8 vs fp32: {exact}/{len(prefixes)} identical greedy outputs, "
+          f"{sum(prefixes) / len(prefixes):.0%} of tokens agree before first divergence")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Micro-benchmark: building the RAG context for repeated questions, with and without the query/context caches
+
+All seaside_cottage documents are discovered, then the scripted questions are
+asked --repeats times over (players re-click the suggested questions). Cached
+contexts are checked against freshly built ones.
+
+    python -m benchmarks.rag_cache --repeats 20
+"""
+import argparse
+
+import config
+from benchmarks.common import SEASIDE_QUESTIONS, timed
+from data.case_manager import CaseDocumentManager
+from utils.document_system import RAGSystem
+
+
+def run(documents, repeats, cache_size):
+    """(contexts of the last pass, mean ms per question, cache stats)"""
+    config.RAG_QUERY_CACHE_SIZE = config.RAG_CONTEXT_CACHE_SIZE = cache_size
+    rag = RAGSystem()
+    rag.add_documents(documents)
+    elapsed = 0.0
+    for _ in range(repeats):
+        contexts = []
+        for question in SEASIDE_QUESTIONS:
+            context, seconds = timed(rag.create_context_for_prompt, question)
+            contexts.append(context)
+            elapsed += seconds
+    return contexts, elapsed * 1000 / (repeats * len(SEASIDE_QUESTIONS)), rag.cache_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    documents = list(CaseDocumentManager("seaside_cottage").discovery_system.documents.values())
+
+    uncached, uncached_ms, _ = run(documents, args.repeats, 0)
+    cached, cached_ms, stats = run(documents, args.repeats, 64)
+    assert cached == uncached
+
+    print(f"uncached {uncached_ms:.3f} ms/question, cached {cached_ms:.3f} ms/question "
+          f"({uncached_ms / cached_ms:.0f}x)")
+    print(f"cache stats: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Micro-benchmark: RAGSystem retrieval latency as a case grows to hundreds of documents
+
+Synthetic documents are built by repeating sentences from the seaside_cottage
+case, so only the tokenizer is needed (no model). Scoring through the stacked
+document matrix is timed against the old per-document loop, and both are
+checked to return the same scores. The RAG caches are turned off, so every
+query is embedded and scored.
+
+    python -m benchmarks.retrieval --docs 10 100 500 1000
+"""
+import argparse
+import random
+import time
+
+import torch
+
+import config
+from benchmarks.common import SEASIDE_QUESTIONS
+from data.case_manager import CaseDocumentManager
+from utils.document_system import Document, RAGSystem, SparseEmbedding
+
+
+def synthetic_documents(source_docs, count, seed=0):
+    """`count` documents mixing random sentences of the real case documents"""
+    rng = random.Random(seed)
+    sentences = [s.strip() for doc in source_docs for s in doc.content.split(".") if s.strip()]
+    return [
+        Document(
+            id=f"synthetic_{i}",
+            title=rng.choice(source_docs).title,
+            content=". ".join(rng.sample(sentences, 6)),
+            keywords=[],
+            category="records",
+            importance=1
+        )
+        for i in range(count)
+    ]
+
+
+def sparse_dot(a: SparseEmbedding, b: SparseEmbedding) -> float:
+    """Cosine similarity of two normalized sparse embeddings, one pair at a time"""
+    # Both id lists are sorted, so the shared entries line up
+    return torch.dot(a.weights[torch.isin(a.token_ids, b.token_ids)], b.weights[torch.isin(b.token_ids, a.token_ids)]).item()
+
+
+def loop_retrieval(rag, query, top_k=3):
+    """The previous implementation: score documents one at a time and sort in Python"""
+    query_embedding = rag._get_embedding(query)
+    similarities = [(doc_id, sparse_dot(query_embedding, embedding)) for doc_id, embedding in rag.document_embeddings.items()]
+    similarities.sort(key=lambda x: x[1], reverse=True)
+    return [(rag.documents[doc_id], score) for doc_id, score in similarities[:top_k] if score > 0.1]
+
+
+def per_query_ms(fn, queries, repeats):
+    """Mean milliseconds per query"""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for query in queries:
+            fn(query)
+    return (time.perf_counter() - start) * 1000 / (repeats * len(queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, nargs="+", default=[10, 100, 500, 1000], help="Case sizes to time")
+    parser.add_argument("--repeats", type=int, default=20, help="Passes over the question list per case size")
+    args = parser.parse_args()
+
+    case = CaseDocumentManager("seaside_cottage")
+    source_docs = list(case.discovery_system.documents.values())
+
+    # The questions repeat every pass - with the query cache on, the matrix timings would mostly be cache hits
+    config.RAG_QUERY_CACHE_SIZE = config.RAG_CONTEXT_CACHE_SIZE = 0
+
+    for count in args.docs:
+        rag = RAGSystem()
+        start = time.perf_counter()
+        rag.add_documents(synthetic_documents(source_docs, count))
+        build_s = time.perf_counter() - start
+
+        for query in SEASIDE_QUESTIONS:
+            # Synthetic documents often tie, and topk may order ties differently - compare the scores
+            expected = [score for _, score in loop_retrieval(rag, query)]
+            actual = [score for _, score in rag.retrieve_relevant_documents(query)]
+            assert len(expected) == len(actual) and all(abs(a - b) < 1e-5 for a, b in zip(expected, actual)), \
+                f"retrieval differs for {query!r}: {expected} vs {actual}"
+
+        embed_ms = per_query_ms(rag._get_embedding, SEASIDE_QUESTIONS, args.repeats)
+        loop_ms = per_query_ms(lambda q: loop_retrieval(rag, q), SEASIDE_QUESTIONS, args.repeats)
+        matrix_ms = per_query_ms(rag.retrieve_relevant_documents, SEASIDE_QUESTIONS, args.repeats)
+        print(f"{count:5d} docs: indexed in {build_s:.2f}s, query embedding {embed_ms:.3f} ms, "
+              f"loop {loop_ms:.3f} ms/query, matrix {matrix_ms:.3f} ms/query "
+              f"(scoring {loop_ms - embed_ms:.3f} -> {matrix_ms - embed_ms:.3f} ms)")
+
+
+if __name__ == "__main__":
+    main()
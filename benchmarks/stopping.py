@@ -0,0 +1,55 @@
+"""
+Benchmark: tokens generated vs tokens kept per turn, with and without stop conditions
+
+"before" decodes the full 250-token budget like respond() used to; "after" uses
+the speaker-tag stop strings, sentence budget and character-derived token cap.
+Kept tokens are the tokens of the model text that survives _clean_response.
+
+    python -m benchmarks.stopping --runs 2
+"""
+import argparse
+import statistics
+
+from benchmarks.common import SEASIDE_QUESTIONS, load_model_manager, timed
+from components.detective_ai import DetectiveAI
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=2, help="Repetitions per prompt")
+    args = parser.parse_args()
+
+    model_manager = load_model_manager()
+    detective = DetectiveAI(model_manager)
+    detective.initialize_case("seaside_cottage")
+
+    prompts = []
+    for question in SEASIDE_QUESTIONS:
+        _, rag_context = detective.document_manager.process_input(question)
+        prompts.append(detective._build_prompt(question, rag_context))
+
+    modes = {
+        "before": {},
+        "after": detective._stopping_kwargs(""),
+    }
+    for label, stopping_kwargs in modes.items():
+        generated, kept, seconds = [], [], []
+        for prompt in prompts:
+            for _ in range(args.runs):
+                response, elapsed = timed(
+                    model_manager.generate_response,
+                    prompt, max_length=250, temperature=0.7,
+                    prefix_cache=detective.prefix_cache, **stopping_kwargs
+                )
+                cleaned = detective._clean_response(response)
+                generated.append(model_manager.last_generation_stats["generated_tokens"])
+                kept.append(len(model_manager.tokenizer.encode(cleaned, add_special_tokens=False)))
+                seconds.append(elapsed)
+        print(f"{label:>6}: {statistics.mean(generated):6.1f} tokens generated, "
+              f"{statistics.mean(kept):6.1f} kept per turn "
+              f"({statistics.mean(kept) / max(statistics.mean(generated), 1):.0%}), "
+              f"{statistics.mean(seconds):.2f} s/turn")
+
+
+if __name__ == "__main__":
+    main()
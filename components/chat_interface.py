@@ -1,52 +1,77 @@
 import streamlit as st
-from typing import List, Dict
+from typing import Callable, List, Dict
+
+from utils.chat_log import ChatLog
 
 
 class ChatInterface:
     """Handles the chat interface rendering in Streamlit"""
 
+    USER_AVATAR = "🕵️‍♂️"
+    AI_AVATAR = "🤖"
+
     def __init__(self):
-        self.max_messages = 20  # Limit displayed messages for performance
+        self.max_messages = 20  # Limit displayed messages for performance - "Load earlier" shows more
+
+    def render_chat(self, chat_log: ChatLog = None, get_document: Callable = None):
+        """
+        Render the latest messages of the conversation, with a button to page back through older ones
 
-    def render_chat(self):
-        """Render the chat conversation"""
-        if 'chat_history' not in st.session_state:
-            st.session_state.chat_history = []
+        Args:
+            chat_log: The session's messages - defaults to st.session_state.chat_log
+            get_document: Document id -> Document, to name the clues discovered with a message
+        """
+        if chat_log is None:
+            if 'chat_log' not in st.session_state:
+                st.session_state.chat_log = ChatLog()
+            chat_log = st.session_state.chat_log
+        if 'chat_window' not in st.session_state:
+            st.session_state.chat_window = self.max_messages
+
+        if len(chat_log) > st.session_state.chat_window:
+            hidden = len(chat_log) - st.session_state.chat_window
+            if st.button(f"⬆️ Load earlier ({hidden} more)", key="load_earlier"):
+                st.session_state.chat_window += self.max_messages
+                st.rerun()
 
         # Create a container for messages
         chat_container = st.container()
 
         with chat_container:
-            # Show recent messages (limit for performance)
-            recent_messages = st.session_state.chat_history[-self.max_messages:]
-
-            for message in recent_messages:
-                if message["role"] == "user":
-                    self._render_user_message(message["content"])
+            # Only the window is rendered (and read back from disk, if it reaches that far)
+            for role, content, discovered_ids in chat_log.latest(st.session_state.chat_window):
+                if role == "user":
+                    self._render_user_message(content)
                 else:
-                    self._render_ai_message(message["content"])
+                    self._render_ai_message(content, discovered_ids, get_document)
+
+    def reset_window(self):
+        """Go back to showing only the latest messages, e.g. for a new case"""
+        st.session_state.chat_window = self.max_messages
 
     def _render_user_message(self, content: str):
         """Render a user message"""
-        with st.chat_message("user", avatar="🕵️‍♂️"):
+        with st.chat_message("user", avatar=self.USER_AVATAR):
             st.write(content)
 
-    def _render_ai_message(self, content: str):
-        """Render an AI message"""
-        with st.chat_message("assistant", avatar="🤖"):
+    def _render_ai_message(self, content: str, discovered_ids=(), get_document: Callable = None):
+        """Render an AI message, with the clues discovered in that turn"""
+        with st.chat_message("assistant", avatar=self.AI_AVATAR):
             st.write(content)
+            for doc_id in discovered_ids:
+                doc = get_document(doc_id) if get_document else None
+                st.info(f"🔍 New clue discovered: {doc.title if doc else doc_id}")
 
-    def add_message(self, role: str, content: str):
+    def add_message(self, role: str, content: str, discovered_ids=()):
         """Add a message to the chat history"""
-        if 'chat_history' not in st.session_state:
-            st.session_state.chat_history = []
+        if 'chat_log' not in st.session_state:
+            st.session_state.chat_log = ChatLog()
 
-        st.session_state.chat_history.append({
-            "role": role,
-            "content": content
-        })
+        st.session_state.chat_log.append(role, content, discovered_ids)
 
     def clear_chat(self):
         """Clear the chat history"""
-        st.session_state.chat_history = []
-        st.rerun()
\ No newline at end of file
+        if 'chat_log' in st.session_state:
+            st.session_state.chat_log.clear()
+        self.reset_window()
+        st.rerun()
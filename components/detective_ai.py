@@ -2,7 +2,9 @@
 Detective AI with document discovery and RAG capabilities
 """
 import random
-from typing import List, Dict, Tuple
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterator, List, Dict, Tuple
 import sys
 import os
 
@@ -10,6 +12,18 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from data.case_manager import CaseDocumentManager
 from utils.document_system import Document
+from models.kv_cache import SessionCache
+from utils.helpers import ViewCache
+import config
+
+
+@dataclass(frozen=True)
+class DetectiveSnapshot:
+    """A point in a playthrough DetectiveAI.restore() can go back to - only references, never copies"""
+    document_manager: CaseDocumentManager  # The case session it belongs to
+    conversation_history: Tuple[str, ...]
+    last_response: str
+    documents: tuple  # CaseDocumentManager.snapshot()
 
 
 class DetectiveAI:
@@ -21,10 +35,15 @@ class DetectiveAI:
     def __init__(self, model_manager):
         self.model_manager = model_manager
         self.current_case = None
-        self.conversation_history = []
+        self.conversation_history = ()  # Immutable, so snapshots share it
         self.personality_prompt = self._create_detective_personality()
         self.document_manager = None
         self.recent_discoveries = []
+        self.last_response = ""
+        self.prefix_cache = None
+        self.session_cache = None
+        self.undo_snapshots = deque(maxlen=config.UNDO_LIMIT)  # State before each recent turn
+        self._views = ViewCache()  # Sidebar views, so Streamlit reruns that changed nothing recompute nothing
 
     def _create_detective_personality(self): # needs attention
         """Create the detective's personality and behavior prompt"""
@@ -43,11 +62,13 @@ class DetectiveAI:
     def initialize_case(self, case_name: str):
         """Initialize a new case with document system"""
         self.current_case = case_name
-        self.conversation_history = []
+        self.conversation_history = ()
         self.recent_discoveries = []
+        self.undo_snapshots.clear()
 
         # Initialize document management system
-        self.document_manager = CaseDocumentManager(case_name)
+        self.document_manager = CaseDocumentManager(case_name, self.model_manager.input_embeddings(),
+                                                     self.model_manager.tokenizer)
 
         # Case-specific setup - Model has access, how to share with the player?
         if case_name == "seaside_cottage":
@@ -68,6 +89,39 @@ class DetectiveAI:
         else:
             self.case_context = "A mysterious case that needs solving..."
 
+        self._init_model_caches()
+
+    def use_model_manager(self, model_manager):
+        """Switch to another ModelManager (e.g. after the model was reloaded), keeping the case progress"""
+        self.model_manager = model_manager
+        if self.current_case:
+            self._init_model_caches()
+
+    def _init_model_caches(self):
+        """Set up the KV caches for the current case on the current model"""
+        # Personality and case context open every prompt - prefilled once per case and model, for every session
+        self.prefix_cache = None
+        if config.USE_PREFIX_CACHE:
+            try:
+                self.prefix_cache = self.model_manager.get_prefix_cache(self._build_prompt_prefix())
+            except Exception as e:
+                print(f"Could not build prefix cache: {e}")
+
+        # KV state of the previous turn, so each turn only prefills what changed
+        self.session_cache = None
+        if config.SESSION_CACHE_MAX_TOKENS > 0:
+            self.session_cache = SessionCache(self.prefix_cache, max_tokens=config.SESSION_CACHE_MAX_TOKENS)
+
+    # Speaker tags that mean the model has moved past the end of Marco's turn
+    STOP_STRINGS = ["Partner:", "\nDetective Marco:", "\nHuman:"]
+
+    FALLBACK_RESPONSES = [
+        "Hmm, let me think about that for a moment...",
+        "That's an interesting observation, partner.",
+        "I need to process what you just told me.",
+        "Something about this case is puzzling me right now."
+    ]
+
     def respond(self, user_input: str) -> Tuple[str, List[Document]]:
         """
         Generate a response to user input with document discovery
@@ -78,6 +132,8 @@ class DetectiveAI:
         Returns:
             Tuple[str, List[Document]]: Detective's response and any newly discovered documents
         """
+        self.undo_snapshots.append(self.snapshot())
+
         # Process input for document discovery and get RAG context
         newly_discovered, rag_context = self.document_manager.process_input(user_input)
 
@@ -85,52 +141,145 @@ class DetectiveAI:
         full_prompt = self._build_prompt(user_input, rag_context)
 
         try:
-            ai_response = ""
             # Add discovery announcements if any new documents were found
-            if newly_discovered:
-                discovery_announcements = []
-                for doc in newly_discovered:
-                    discovery_announcements.append(f"🔍 {doc.discovery_message}")
-
-                # Add excitement about discoveries
-                discovery_text = "\n\n" + "\n".join(discovery_announcements)
-                ai_response += discovery_text
-
-            # Add some detective commentary about the discoveries
-            ai_response += f"\n\nThis is interesting! We just uncovered {len(newly_discovered)} new clue{'s' if len(newly_discovered) > 1 else ''}. Let me think about what this means..."
+            ai_response = self._discovery_announcement(newly_discovered)
 
             # Generate response using the model manager
-            ai_response += self.model_manager.generate_response(
+            generated = self.model_manager.generate_response(
                 prompt=full_prompt,
                 max_length=250,  # Increased for more detailed responses
-                temperature=0.7 # Adjust for flare
+                temperature=0.7, # Adjust for flare
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+                **self._stopping_kwargs(ai_response)
             )
+            ai_response += generated
 
-            # Clean up the response
-            ai_response = self._clean_response(ai_response)
-
-            # Add user input and AI response to conversation history
-            self.conversation_history.append(f"Partner: {user_input}")
-            self.conversation_history.append(f"Detective Marco: {ai_response}")
+            # Clues Marco mentions himself are discovered too
+            scanner = self.document_manager.response_scanner()
+            newly_discovered = newly_discovered + self.document_manager.process_response_chunk(scanner, generated)
+            newly_discovered += self.document_manager.finish_response(scanner)
 
-            return ai_response, newly_discovered
+            return self._finish_turn(user_input, ai_response), newly_discovered
 
         except Exception as e:
             # Fallback response if model fails
-            fallback_responses = [
-                "Hmm, let me think about that for a moment...",
-                "That's an interesting observation, partner.",
-                "I need to process what you just told me.",
-                "Something about this case is puzzling me right now."
-            ]
-            return random.choice(fallback_responses), newly_discovered
+            return random.choice(self.FALLBACK_RESPONSES), newly_discovered
 
-    def _build_prompt(self, user_input: str, rag_context: str) -> str:
-        """Build the complete prompt for the model with RAG context"""
-        prompt_parts = [
+    def respond_stream(self, user_input: str) -> Tuple[Iterator[str], List[Document]]:
+        """
+        Streaming variant of respond()
+
+        Discovery of the player's input runs up front, so those documents are
+        known immediately; the returned iterator yields the discovery
+        announcements first and then the model's text as it is decoded. Clues
+        Marco mentions are discovered while he is still talking and appended to
+        the returned list. Once the iterator is exhausted the cleaned response
+        is recorded in the conversation history and available as `last_response`.
+
+        Args:
+            user_input: The user's message/question
+
+        Returns:
+            Tuple[Iterator[str], List[Document]]: Stream of response text and the newly discovered documents -
+                complete once the stream is exhausted
+        """
+        self.undo_snapshots.append(self.snapshot())
+        newly_discovered, rag_context = self.document_manager.process_input(user_input)
+        full_prompt = self._build_prompt(user_input, rag_context)
+        return self._stream_turn(user_input, full_prompt, newly_discovered), newly_discovered
+
+    def _stream_turn(self, user_input: str, full_prompt: str, newly_discovered: List[Document]) -> Iterator[str]:
+        """
+        Yield the announcement and model text for one turn, then record the exchange
+
+        Only text _clean_response is sure to keep is yielded, so the stream
+        adds up to exactly the recorded reply.
+        """
+        announcement = self._discovery_announcement(newly_discovered)
+        shown = self._settled_response(announcement)
+        if shown:
+            yield shown
+
+        generated = ""
+        # Matches carry over between chunks, so a clue split across two chunks is still found
+        scanner = self.document_manager.response_scanner()
+        try:
+            for chunk in self.model_manager.generate_response_stream(
+                prompt=full_prompt,
+                max_length=250,
+                temperature=0.7,
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+                **self._stopping_kwargs(announcement)
+            ):
+                if not generated:
+                    chunk = chunk.lstrip()
+                    if not chunk:
+                        continue
+                generated += chunk
+                newly_discovered.extend(self.document_manager.process_response_chunk(scanner, chunk))
+                settled = self._settled_response(announcement + generated)
+                if len(settled) > len(shown):
+                    yield settled[len(shown):]
+                    shown = settled
+            newly_discovered.extend(self.document_manager.finish_response(scanner))
+        except Exception as e:
+            # Fallback response if model fails - after whatever the player has already seen
+            fallback = ("\n\n" if shown else "") + random.choice(self.FALLBACK_RESPONSES)
+            self.last_response = shown + fallback
+            yield fallback
+            return
+
+        response = self._finish_turn(user_input, announcement + generated)
+        if len(response) > len(shown):
+            yield response[len(shown):]
+
+    def _stopping_kwargs(self, announcement: str) -> Dict:
+        """Stop conditions for the model's part of a reply, given the announcement that precedes it"""
+        # _clean_response truncates the whole reply, so the model only gets what the announcement leaves over
+        max_chars = max(config.RESPONSE_MAX_CHARS - len(announcement), config.RESPONSE_MIN_MODEL_CHARS)
+        return {
+            "stop_strings": self.STOP_STRINGS,
+            "max_chars": max_chars,
+            "sentence_budget": int(max_chars * config.RESPONSE_SENTENCE_FRACTION),
+        }
+
+    def _discovery_announcement(self, newly_discovered: List[Document]) -> str:
+        """Build the text announcing newly discovered documents, if any"""
+        if not newly_discovered:
+            return ""
+
+        discovery_announcements = []
+        for doc in newly_discovered:
+            discovery_announcements.append(f"🔍 {doc.discovery_message}")
+
+        # Add some detective commentary about the discoveries
+        return (
+            "\n".join(discovery_announcements)
+            + f"\n\nThis is interesting! We just uncovered {len(newly_discovered)} new clue{'s' if len(newly_discovered) > 1 else ''}. Let me think about what this means...\n\n"
+        )
+
+    def _finish_turn(self, user_input: str, ai_response: str) -> str:
+        """Clean up the response and add the exchange to the conversation history"""
+        ai_response = self._clean_response(ai_response)
+
+        # Add user input and AI response to conversation history
+        self.conversation_history += (f"Partner: {user_input}", f"Detective Marco: {ai_response}")
+        self.last_response = ai_response
+
+        return ai_response
+
+    def _build_prompt_prefix(self) -> str:
+        """Build the static start of every prompt: personality and case context"""
+        return "\n".join([
             self.personality_prompt,
             f"\nCASE DETAILS:\n{self.case_context}" if self.current_case else "",
-        ]
+        ])
+
+    def _build_prompt(self, user_input: str, rag_context: str) -> str:
+        """Build the complete prompt for the model with RAG context"""
+        prompt_parts = [self._build_prompt_prefix()]
 
         # Add RAG context if available
         if rag_context:
@@ -152,30 +301,60 @@ class DetectiveAI:
 
         return "\n".join(prompt_parts)
 
+    # Speaker tags the model sometimes opens its reply with
+    SPEAKER_PREFIXES = ["Detective Marco:", "Marco:", "Detective:"]
+
+    # A text after the last full stop shorter than this is dropped as an incomplete sentence
+    MIN_TRAILING_SENTENCE = 10
+
     def _clean_response(self, response: str) -> str:
         """Clean up the model's response"""
         # Remove any unwanted prefixes that might be generated
-        prefixes_to_remove = ["Detective Marco:", "Marco:", "Detective:"]
-        for prefix in prefixes_to_remove:
+        for prefix in self.SPEAKER_PREFIXES:
             if response.startswith(prefix):
                 response = response[len(prefix):].strip()
 
         # Remove any trailing incomplete sentences or weird artifacts
         sentences = response.split('.')
-        if len(sentences) > 1 and len(sentences[-1].strip()) < 10:
+        if len(sentences) > 1 and len(sentences[-1].strip()) < self.MIN_TRAILING_SENTENCE:
             response = '.'.join(sentences[:-1]) + '.'
 
         # Ensure response isn't too long
-        if len(response) > 400:
-            response = response[:400] + "..."
+        if len(response) > config.RESPONSE_MAX_CHARS:
+            response = response[:config.RESPONSE_MAX_CHARS] + "..."
 
         return response.strip()
 
+    def _settled_response(self, partial: str) -> str:
+        """
+        The start of _clean_response(partial + more) that no continuation can change
+
+        Used while streaming, so nothing the player has seen is taken back once
+        the whole reply is cleaned.
+        """
+        # A speaker prefix can't be ruled in or out until there is enough text
+        for prefix in self.SPEAKER_PREFIXES:
+            if len(partial) < len(prefix) and prefix.startswith(partial):
+                return ""
+            if partial.startswith(prefix):
+                partial = partial[len(prefix):].lstrip()
+
+        # A short text after the last full stop may still be dropped as an incomplete sentence
+        last_stop = partial.rfind('.')
+        if last_stop >= 0 and len(partial[last_stop + 1:].strip()) < self.MIN_TRAILING_SENTENCE:
+            partial = partial[:last_stop + 1]
+
+        # Trailing whitespace only survives if more text follows
+        return partial[:config.RESPONSE_MAX_CHARS].strip()
+
     def get_case_summary(self) -> str:
         """Get a comprehensive summary of the case progress"""
         if not self.document_manager:
             return "No case initialized."
+        version = (self.document_manager.version, len(self.conversation_history))
+        return self._views.get("summary", version, self._build_case_summary)
 
+    def _build_case_summary(self) -> str:
         summary_parts = [
             f"CASE: {self.current_case}",
             f"Conversation exchanges: {len(self.conversation_history) // 2}",
@@ -185,14 +364,31 @@ class DetectiveAI:
 
         return "\n".join(summary_parts)
 
-    def get_discovered_documents(self) -> List[Document]:
+    def get_discovered_documents(self) -> Tuple[Document, ...]:
         """Get all discovered documents"""
         if not self.document_manager:
-            return []
+            return ()
         return self.document_manager.get_discovered_documents()
 
-    def suggest_next_questions(self) -> List[str]:
-        """Suggest questions the player might ask to discover more clues"""
+    def get_document(self, doc_id: str) -> Document:
+        """A document of the current case by id (the solution too, once found), or None"""
+        if not self.document_manager:
+            return None
+        return self.document_manager.get_document(doc_id)
+
+    def get_discovered_clues_markdown(self) -> str:
+        """Every discovered document as one markdown block for the clues panel - rebuilt only after a discovery"""
+        version = self.document_manager.version if self.document_manager else None
+        return self._views.get("clues_markdown", version, lambda: "".join(
+            f"**{doc.title}** ({doc.category})\n\n{doc.content}\n\n---\n\n" for doc in self.get_discovered_documents()
+        ))
+
+    def suggest_next_questions(self) -> Tuple[str, ...]:
+        """Suggest questions the player might ask to discover more clues - rebuilt only after a discovery"""
+        version = self.document_manager.version if self.document_manager else None
+        return self._views.get("suggestions", version, self._build_suggestions)
+
+    def _build_suggestions(self) -> Tuple[str, ...]:
         discovered_docs = self.get_discovered_documents()
         discovered_categories = {doc.category for doc in discovered_docs}
         discovered_ids = {doc.id for doc in discovered_docs}
@@ -226,15 +422,56 @@ class DetectiveAI:
         if "background_check" not in discovered_categories:
             suggestions.append("What about the backgrounds of the suspects?")
 
-        return suggestions[:3]  # Return top 3 suggestions
+        return tuple(suggestions[:3])  # Return top 3 suggestions
+
+    def snapshot(self) -> DetectiveSnapshot:
+        """
+        Capture the conversation, discoveries and retrieval state - constant time
+
+        Returns:
+            DetectiveSnapshot to pass to restore(), any number of times
+        """
+        return DetectiveSnapshot(
+            document_manager=self.document_manager,
+            conversation_history=self.conversation_history,
+            last_response=self.last_response,
+            documents=self.document_manager.snapshot() if self.document_manager else None
+        )
+
+    def restore(self, snapshot: DetectiveSnapshot):
+        """
+        Go back to an earlier snapshot of this case - e.g. to undo questions or branch a playthrough
+
+        No case data is reloaded. The session KV cache isn't part of the
+        snapshot: it already drops whatever no longer matches the next prompt.
+
+        Args:
+            snapshot: From snapshot(), taken since the current case was initialized
+        """
+        if snapshot.document_manager is not self.document_manager:
+            raise ValueError("Snapshot belongs to a different case - it can't be restored here")
+        self.conversation_history = snapshot.conversation_history
+        self.last_response = snapshot.last_response
+        if self.document_manager:
+            self.document_manager.restore(snapshot.documents)
+
+    def undo_last_turn(self) -> bool:
+        """Take back the last question and everything it discovered, returning False if there is nothing to undo"""
+        if not self.undo_snapshots:
+            return False
+        self.restore(self.undo_snapshots.pop())
+        return True
 
     def reset_conversation(self):
         """Reset the conversation history but keep discovered documents"""
-        self.conversation_history = []
+        self.conversation_history = ()
+        self.undo_snapshots.clear()
 
     def reset_case(self):
         """Reset everything including discovered documents"""
-        self.conversation_history = []
+        self.conversation_history = ()
         self.recent_discoveries = []
+        self.last_response = ""
+        self.undo_snapshots.clear()
         if self.document_manager:
-            self.document_manager = CaseDocumentManager(self.current_case)
\ No newline at end of file
+            self.document_manager.reset()
\ No newline at end of file
@@ -1,15 +1,52 @@
 # Model settings - I dont think this is used anymore
 DEFAULT_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
 CUSTOM_MODEL_PATH = "models/saved_models/detective_v1" # wrong path - but doesn't matter for now
+CPU_INFERENCE_MODE = "fp32" # "fp32", or "int8" for dynamically quantized Linear layers (less memory, faster matmuls)
+MERGE_LORA_ADAPTER = False # Fold the LoRA adapter into the base weights - no adapter matmuls per token
+MERGED_MODEL_CACHE_DIR = "models/saved_models/merged" # Merged snapshots, one per base model + adapter hash
+MODEL_MEMORY_LIMIT_GB = 12 # Ceiling for all models loaded in this process (shared across sessions), 0 = no limit
+
+# Batching settings - concurrent players' requests share generate calls
+BATCH_SCHEDULER_ENABLED = False # Batched requests skip the per-session KV caches, so only worth it under load
+BATCH_MAX_SIZE = 8 # Most requests decoded together
+BATCH_WINDOW_MS = 20 # How long the scheduler waits for more requests to join a batch
+BATCH_REQUEST_TIMEOUT = 120 # Seconds before a request is dropped from the queue or cut short
 
 # Generation settings
 MAX_RESPONSE_LENGTH = 256 # Cap on generated tokens for speed/memory
 TEMPERATURE = 0.7
 TOP_P = 0.9
+RESPONSE_MAX_CHARS = 400 # Replies are truncated to this many characters
+RESPONSE_MIN_MODEL_CHARS = 120 # Budget left for the model after long discovery announcements
+RESPONSE_SENTENCE_FRACTION = 0.75 # Stop at the next sentence end once this share of the budget is used
+MIN_CHARS_PER_TOKEN = 3 # Conservative chars/token for TinyLLaMA - turns a char limit into a token cap
+NO_REPEAT_NGRAM_SIZE = 2 # Never repeat an n-gram of this size, 0 disables
+NO_REPEAT_INCLUDE_PROMPT = True # Also ban n-grams from the prompt - False lets Marco quote evidence (and prompt lookup drafts)
+STREAM_TIMEOUT = 120 # Seconds to wait for the next streamed chunk before giving up
+USE_PREFIX_CACHE = True # Prefill personality + case context once per case and model, shared by every session
+SESSION_CACHE_MAX_TOKENS = 2048 # KV tokens kept between turns per session (~45 KB/token in fp32), 0 disables
+PROMPT_LOOKUP_NUM_TOKENS = 0 # Speculative tokens drafted from matching prompt n-grams per step, 0 disables
+PROMPT_LOOKUP_MAX_NGRAM = 3 # Longest n-gram matched against the prompt when drafting
+
+# Discovery settings
+DISCOVERY_WHOLE_WORDS = False # Clue keywords only trigger as whole words ("art" stops firing inside "start", but "footprint" won't match "footprints")
+
+# Retrieval settings
+RAG_RETRIEVAL_MODE = "tokens" # "tokens" (token overlap), "dense" (mean of the loaded model's input embeddings) or "bm25" (keywords)
+RAG_EMBEDDING_CACHE_DIR = "models/saved_models/rag_embeddings" # Dense document vectors, one file per model + document text
+RAG_CONTEXT_MAX_TOKENS = 160 # Token budget for the retrieved evidence in each prompt
+RAG_QUERY_CACHE_SIZE = 256 # Query embeddings kept per session (LRU), 0 disables
+RAG_CONTEXT_CACHE_SIZE = 64 # Built prompt contexts kept per session (LRU, per query + discovered documents), 0 disables
+RAG_PASSAGE_MAX_TOKENS = 48 # Documents are split into passages of at most this many tokens (single long sentences excepted)
+USE_CASE_INDEX = True # Serve case documents from a prebuilt, memory-mapped index shared by every session
+CASE_INDEX_DIR = "models/saved_models/case_indexes" # Built on first use, or ahead of time: python -m utils.case_index <case>
 
 # App settings
-CHAT_HISTORY_LIMIT = 50
+CHAT_HISTORY_LIMIT = 50 # Chat messages kept in memory per session - older ones are spilled to CHAT_SPILL_DIR
+CHAT_SPILL_DIR = None # Directory for the one temporary file per long-running session, None = system temp dir
+UNDO_LIMIT = 20 # Questions "Undo" can take back (each keeps a snapshot of references, not copies)
 CASE_DATA_PATH = "data/cases/"
 
 # Debug settings
-DEBUG_MODE = True
\ No newline at end of file
+DEBUG_MODE = True
+LOG_LEVEL = "DEBUG" if DEBUG_MODE else "INFO" # "DEBUG" logs every discovery and view rebuild, "INFO" keeps turns quiet
@@ -0,0 +1,87 @@
+"""
+Process-wide catalog of detective cases, loaded from data/cases/<case>.json
+
+A case is read the first time any session plays it and then shared, read-only,
+by every session - so starting a session doesn't rebuild its documents, and
+cases nobody plays are never loaded.
+"""
+import hashlib
+import os
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Tuple
+
+import config
+from utils.document_system import Document
+from utils.helpers import load_case_data
+from utils.keyword_matcher import KeywordAutomaton
+
+
+@dataclass(frozen=True)
+class CaseData:
+    """One case's documents plus everything derived from them - never modified, so sessions can share it"""
+    name: str
+    documents: Tuple[Document, ...]
+    documents_by_id: Mapping[str, Document]
+    positions: Mapping[str, int]  # Document id -> index in documents, its bit in a session's discovery bitset
+    keyword_map: Mapping[str, Tuple[str, ...]]  # Lower-cased keyword -> document ids, in document order
+    keyword_automaton: KeywordAutomaton
+    fingerprint: str  # Changes whenever a document's id, title or content does
+
+
+def _build_case(case_name: str, data: dict) -> CaseData:
+    """Turn a case file's contents into a CaseData"""
+    documents = tuple(Document(**doc) for doc in data["documents"])
+
+    keyword_map = {}
+    for doc in documents:
+        for keyword in doc.keywords:
+            keyword_map.setdefault(keyword.lower(), []).append(doc.id)
+
+    digest = hashlib.sha256()
+    for doc in documents:
+        digest.update(f"\0{doc.id}\0{doc.title}\0{doc.content}".encode("utf-8"))
+
+    return CaseData(
+        name=case_name,
+        documents=documents,
+        documents_by_id=MappingProxyType({doc.id: doc for doc in documents}),
+        positions=MappingProxyType({doc.id: position for position, doc in enumerate(documents)}),
+        keyword_map=MappingProxyType({keyword: tuple(doc_ids) for keyword, doc_ids in keyword_map.items()}),
+        keyword_automaton=KeywordAutomaton(list(keyword_map), whole_words=config.DISCOVERY_WHOLE_WORDS),
+        fingerprint=digest.hexdigest()[:16]
+    )
+
+
+_cases = {}
+_cases_lock = threading.Lock()
+
+
+def get_case(case_name: str) -> Optional[CaseData]:
+    """
+    A case from the catalog, loaded on first use
+
+    Args:
+        case_name: File name in config.CASE_DATA_PATH, without .json
+
+    Returns:
+        The shared CaseData, or None if there is no such case
+    """
+    with _cases_lock:
+        case = _cases.get(case_name)
+        if case is None:
+            data = load_case_data(case_name)
+            if data is None:
+                return None  # Not remembered - the file may still be added
+            case = _build_case(case_name, data)
+            _cases[case_name] = case
+            print(f"Loaded case {case_name} ({len(case.documents)} documents)")
+        return case
+
+
+def available_cases() -> List[str]:
+    """Names of every case file - without loading any of them"""
+    if not os.path.isdir(config.CASE_DATA_PATH):
+        return []
+    return sorted(name[:-len(".json")] for name in os.listdir(config.CASE_DATA_PATH) if name.endswith(".json"))
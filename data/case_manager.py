@@ -1,216 +1,36 @@
 """
 Case management system - handles different detective cases and their documents
 """
-from typing import List
+from typing import List, Tuple
+import config
+from data.case_catalog import get_case
 from utils.document_system import DocumentDiscoverySystem, RAGSystem, Document
+from utils.helpers import ViewCache
+from utils.keyword_matcher import KeywordScanner
 
 
 class CaseDocumentManager:
     """Manages documents for a specific case"""
 
-    def __init__(self, case_name: str):
+    def __init__(self, case_name: str, input_embeddings=None, tokenizer=None):
         self.case_name = case_name
-        self.discovery_system = DocumentDiscoverySystem()
-        self.rag_system = RAGSystem()
-        self.setup_case_documents()
-
-    def setup_case_documents(self):
-        """Setup documents for the current case"""
-        if self.case_name == "seaside_cottage": # formerly mystery_mansion
-            self._setup_cottage_documents()
-        elif self.case_name == "art_theft":
-            self._setup_corporate_documents()
-        # Add more cases here as you expand
-
-    def _setup_cottage_documents(self):
-        """Setup documents for the Seaside Cottage case"""
-        documents = [
-            Document(
-                id="guest_list",
-                title="Guests Marco Remembers from Last Night",
-                content="""Guests present: Marco Constantino (myself), 
-                         Charles Rigby (that's you),
-                         Lady Agatha Grimsby, Dr Pike (Horace),
-                         Clara Pike, Eliot and Maeve Grimsby, and Ms Delilah Snipe. 
-                         I remember they stayed until after midnight, when I went to sleep.
-                    """,
-                keywords=["guests", "guest list", "who was there", "visitors", "people", "attendees"],
-                category="records",
-                importance=3,
-                discovery_message="You found out who was at the cottage last night!"
-            ),
-            Document(
-                id="agatha_interview",
-                title="Our First Interview with Lady Agatha",
-                content="""What did you do today?
-                        Well, I suppose the towngoing party departed at about quarter to 7 - a little tardy.
-                        We stopped for breakfast with my friend Beatrice - another of the poor girls husbands died, poor thing.
-                        Horace left partway through to get a fresh fish for a dinner bake from the fishmonger,
-                        I daresay quite rude to leave us, at about quarter of 10.
-                        After breakfast Delilah and I stopped at the gardeners' for an impromptu arrangement. We returned to the cottage a hair past 12...
-                        ... and interrupted my meal in the garden ...
-                        No, Marco, I daresay wet cheese a tomato and bucket of wine do not constitute a meal...
-                        ... dio sancto, non sai cosa stai dicendo! ...
-                        Hmpf! Well, you know the rest.
-                        Yes Mrs Grimsby, I know the rest. Thank you. 
-                    """,
-                keywords=["Agatha", "town", "brunch", "Lady Agatha", "Mrs Grimsby", "going to town", "Agatha Grimsby"],
-                category="witness_statement",
-                importance=2,
-                discovery_message="We didn't learn much from Lady Agatha..."
-            ),
-            Document(
-                id = "agatha_followup_1",
-                title = "Our Next Question for Lady Agatha",
-                content = """ 
-                        Apologies for interrogating you again miss, but when you were leaving to go into the town, 
-                        did you see who delivered the milk? With the note with the H?
-                        No, it wasn't on the step when we left. But we saw Hugo's cart on the road.
-                        He doesn't work for us anymore - but he's still handy - such a kind man.
-                        Hm, ok, thank you.
-                    """,
-                keywords = ["milk", "road", "cart", "Hugo", "groundskeeper", "butler", "kitchen"],
-                category = "witness_statement",
-                importance = 4,
-                discovery_message = "There may be an unfamiliar face to consider..."
-            ),
-            Document(
-                id="maeve_interview",
-                title="Our First Interview with Maeve Grimsby",
-                content=""" You've had such a busy day eh? Tell me about it, please. Indeed, well, Eliot and I left the cottage around 5, quite early.
-                    We reached town before 6, and went with Captain Griggs to resupply the lighthouse.
-                    And these supplies, what were they?
-                    Mostly whiskey, awful quality. Potatoes, bread, I'd imagine those are the typical stoic rations.
-                    Inhumane! Please do continue.
-                    Yes, well we got close to the seamount the lighthouse is on, circled around looking for a safe place to pull in,
-                    but...
-                    But?
-                    But there just wasn't and the fog was coming in fast, so we left.
-                    Or at least that's what Griggs said, but he'd had a little much of that swill for my taste.
-                    And you returned to the cottage at around 11, yes?
-                    Of course, you remember we smoked in the garden.
-                    Sh! Lady Agatha may be able to hear us through the door! Thank you.
-                """,
-                keywords=["sailing", "maeve", "eliot", "daughters", "lighthouse", "art"],
-                category="witness_statement",
-                importance=3,
-                discovery_message="We learn about the failed sailing trip..."
-            ),
-            Document(
-                id="maeve_followup_1",
-                title="We have more Questions for Maeve...",
-                content="""
-                    And Maeve, did yourself or Eliot see anybody on the road when you were going down to the docks?
-                    No - 
-                    Just curious - and did you on your way back?
-                    ... No, why?
-                    I am just checking. And you were with him the entire time, yes?
-                    Yes, until I went to the beach with Clara…
-                    Our victim?
-                    Yes...
-                    And you did not share this before why?!
-                    ...please I was so scared…
-                    Silly girl! And when did she leave you on the beach?
-                    We came back together I swear! 
-                    A likely story! And who maybe saw you together then, hm?
-                    Maybe Delilah? We saw someone looking out from a window when we were on the footpath.
-                    Hmpf! Alright, stay in the study please. We will step away a moment.
-                """,
-                keywords=["beach", "milk", "road", "cart", "window", "upstairs", "with Clara"],
-                category="witness_statement",
-                importance=5,
-                discovery_message="Maeve might have been the last person with Clara!"
-            ),
-            Document(
-                id="griggs_interview",
-                title="We interview Captain Griggs",
-                content=""" 
-                    Buongiorno, Capitano. The air is thick today — but not as thick as the tales you are said to tell.
-                    You here to ask about the sea, or about the girl?
-                    Both. Let us begin with the easier. You left this morning, si?
-                    At first light. Took the Grimsby lad and his lass down the coast. The lighthouse run.
-                    A noble voyage. But... you returned early, yes?
-                    The fog rolled in like a drunk uncle. Couldn’t see ten feet. I turned the boat around at half past ten.
-                    Hmm. And you left them where?
-                    Dropped 'em just where I picked 'em. Back at the dock. Eliot was barking. Maeve — quiet as ever.
-                    And then?
-                    I came back here to town. Nipped into the pub with ol' Hugo for a pint. Better than tea.
-                    Alright, I'll be off. Thank you for your time, Capitano.
-                """,
-                keywords=["captain griggs", "the captain", "griggs"],
-                category="records",
-                importance=2,
-                discovery_message="We don't learn much from Captain Griggs..."
-            ),
-            Document(
-                id="delilahs_notes",
-                title="Delilah’s Annotated Book Page",
-                content="""
-                    Found in Delilah’s room, on her bed. A page corner was folded and faint writing seen in the margin:
-                    'The killer came when the fog was thickest... and he used the sword that was never meant to be seen again.'
-                    Below this: a hand-written note — 'Griggs would never... but Eliot, perhaps? No...'
-                    The underlined passage is from Chapter 12 of 'Blood on the Brambles.'
-                """,
-                keywords=["Delilah", "book", "fog", "Eliot", "Griggs", "notes"],
-                category="literature_note",
-                importance=2,
-                discovery_message="We found a note in Delilah's mystery novel — seems like she's on edge..."
-            ),
-            Document(
-                id="cleaning_receipt",
-                title="Signed Supply Receipt",
-                content="""
-                    Dated the day before the murder. 
-                    'To: Garden Cottage Estate, per standing order. Received by: H. — 1 crate bleach, 1 brush, 2 pairs gloves, 1 soapstone scrub.'
-                    The signature 'H.' is scrawled in black ink.
-                    No one on record has this as an initial — except perhaps Hugo, the former groundskeeper.
-                """,
-                keywords=["receipt", "cleaning supplies", "signature", "evidence", "H."],
-                category="forensic_clue",
-                importance=4,
-                discovery_message="A receipt signed 'H.', but nobody says he works here...."
-            ),
-            Document(
-                id="footprint_report",
-                title="Footprint Found in Attic",
-                content="""
-                    An initial sketch made by Marco before the scene was disturbed:
-                    'Single footprint. Men's size ~10.5, work boot. Slight taper on the right heel.
-                    Not consistent with Eliot (size 8) or Dr. Pike (size 12).
-                    Footprint was near the trunk and sword stand.
-                    Later, footprint seems smudged — possibly tampered with.
-                    The dust pattern suggests someone tried to obscure it post-facto.'
-                """,
-                keywords=["attic", "footprint", "dust", "size", "shoe", "tampered", "work boot"],
-                category="forensic_clue",
-                importance=4,
-                discovery_message="Before it was tampered with, Marco sketched a footprint from the attic. It doesn’t match anybody present...."
-            ),
-
-        ]
-
-        # Add documents to discovery system
-        for doc in documents:
-            self.discovery_system.add_document(doc)
-
-    # Incomplete - art heist not implemented yet
-    def _setup_corporate_documents(self):
-        """Setup documents for a corporate theft case (example for expansion)"""
-        # This is where you'd add documents for other cases
-        documents = [
-            Document(
-                id="employee_records",
-                title="Recent Employee Activity",
-                content="Unusual after-hours access detected for several employees last week...",
-                keywords=["employees", "staff", "access", "after hours"],
-                category="records",
-                importance=3,
-                discovery_message="Employee records show suspicious activity!"
-            )
-        ]
-
-        for doc in documents:
-            self.discovery_system.add_document(doc)
+        self.rag_system = RAGSystem(input_embeddings=input_embeddings, tokenizer=tokenizer)
+        self._views = ViewCache()
+
+        # Case documents come from the shared catalog - loaded once per process, not per session
+        case = get_case(case_name)
+        if case is None:
+            print(f"No case data for {case_name} in {config.CASE_DATA_PATH}")
+            self.discovery_system = DocumentDiscoverySystem()
+            return
+        self.discovery_system = DocumentDiscoverySystem(case)
+
+        self.rag_system.prepare_passages(case.documents, case.fingerprint)
+        if config.USE_CASE_INDEX:
+            try:
+                self.rag_system.use_case_index(case_name, case.documents, case.fingerprint)
+            except Exception as e:
+                print(f"Could not use prebuilt case index, embedding documents as they are discovered: {e}")
 
     def process_input(self, text: str) -> tuple:
         """Process user/AI input for document discovery and RAG context"""
@@ -226,12 +46,69 @@ class CaseDocumentManager:
 
         return newly_discovered, rag_context
 
-    def get_discovered_documents(self) -> List[Document]:
+    def response_scanner(self) -> KeywordScanner:
+        """Start scanning Marco's reply for clues - feed it to process_response_chunk as it is generated"""
+        return self.discovery_system.keyword_scanner()
+
+    def process_response_chunk(self, scanner: KeywordScanner, chunk: str) -> List[Document]:
+        """Discover clues in the next piece of Marco's reply, without rescanning what came before"""
+        newly_discovered = self.discovery_system.check_chunk_for_discoveries(scanner, chunk)
+        if newly_discovered:
+            self.rag_system.add_documents(newly_discovered)
+        return newly_discovered
+
+    def finish_response(self, scanner: KeywordScanner) -> List[Document]:
+        """Discover clues a keyword at the very end of Marco's reply completes"""
+        newly_discovered = self.discovery_system.finish_scan(scanner)
+        if newly_discovered:
+            self.rag_system.add_documents(newly_discovered)
+        return newly_discovered
+
+    def discover_document(self, document: Document) -> bool:
+        """Mark a document discovered without a keyword (e.g. the solution), returning whether it is new"""
+        is_new = self.discovery_system.mark_discovered(document)
+        if is_new:
+            self.rag_system.add_documents([document])
+        return is_new
+
+    def check_solution(self, proposed_solution: str) -> bool:
+        """Check a proposed solution against the case's"""
+        return self.discovery_system.check_solution(proposed_solution)
+
+    def snapshot(self) -> tuple:
+        """Discovery and retrieval state, for restore() - constant time"""
+        return self.discovery_system.snapshot(), self.rag_system.snapshot()
+
+    def restore(self, snapshot: tuple):
+        """Go back to a state from snapshot(), without reloading anything"""
+        discovery, retrieval = snapshot
+        self.discovery_system.restore(discovery)
+        self.rag_system.restore(retrieval)
+
+    def reset(self):
+        """Forget every discovery - the shared case documents and indexes are kept"""
+        self.discovery_system.reset()
+        self.rag_system.reset()
+
+    @property
+    def version(self) -> int:
+        """State version - changes whenever discoveries do, and is never reused by any session"""
+        return self.discovery_system.version
+
+    def get_document(self, doc_id: str) -> Document:
+        """A case document by id, or one added to retrieval (e.g. the solution) - None if unknown"""
+        doc = self.discovery_system.get_document_by_id(doc_id)
+        return doc if doc is not None else self.rag_system.documents.get(doc_id)
+
+    def get_discovered_documents(self) -> Tuple[Document, ...]:
         """Get all discovered documents"""
         return self.discovery_system.get_discovered_documents()
 
     def get_case_summary(self) -> str:
-        """Get a summary of discovered clues"""
+        """Get a summary of discovered clues - rebuilt only after a change"""
+        return self._views.get("summary", self.version, self._build_case_summary)
+
+    def _build_case_summary(self) -> str:
         discovered = self.get_discovered_documents()
         if not discovered:
             return "No clues discovered yet."
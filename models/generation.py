@@ -0,0 +1,212 @@
+"""
+Generation helpers for the detective model - stopping criteria and logits processors
+"""
+import re
+import threading
+from functools import lru_cache
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria
+
+import config
+
+
+class CancelGenerationCriteria(StoppingCriteria):
+    """Stops generation once its event is set, e.g. when a streaming consumer goes away"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        """Ask the running generation to stop at the next decode step"""
+        self.event.set()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class NoRepeatNGramProcessor(LogitsProcessor):
+    """
+    Tensor-based replacement for transformers' `no_repeat_ngram_size`
+
+    Bans every token that would complete an n-gram already in the sequence.
+    The stock processor rebuilds a Python dict of all n-grams on every decode
+    step; here the n-grams are a strided view of `input_ids` and the lookup is
+    one vectorized comparison against the last n-1 tokens. It keeps no state,
+    so it also works when assisted decoding rewinds the sequence.
+
+    With `ignore_before` set to the prompt length only the reply's own
+    n-grams are banned, so the model may still quote the prompt (evidence,
+    earlier turns) verbatim.
+    """
+
+    def __init__(self, ngram_size: int = 2, ignore_before: int = 0):
+        if ngram_size < 1:
+            raise ValueError(f"ngram_size must be a positive integer, got {ngram_size}")
+        self.ngram_size = ngram_size
+        self.ignore_before = ignore_before
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        tokens = input_ids[:, self.ignore_before:]
+        if tokens.shape[1] < self.ngram_size:
+            return scores
+
+        if self.ngram_size == 1:
+            return scores.scatter(1, tokens, -float("inf"))
+
+        ngrams = tokens.unfold(1, self.ngram_size, 1)  # [batch, count, n]
+        current = tokens[:, tokens.shape[1] - self.ngram_size + 1:]  # last n-1 tokens
+        matches = (ngrams[:, :, :-1] == current[:, None, :]).all(dim=-1)
+        rows, positions = matches.nonzero(as_tuple=True)
+        scores[rows, ngrams[rows, positions, -1]] = -float("inf")
+        return scores
+
+
+def repetition_processors(prompt_length: int) -> LogitsProcessorList:
+    """The game's repetition control for a prompt of `prompt_length` tokens, as set in config"""
+    processors = LogitsProcessorList()
+    if config.NO_REPEAT_NGRAM_SIZE:
+        processors.append(NoRepeatNGramProcessor(
+            config.NO_REPEAT_NGRAM_SIZE,
+            ignore_before=0 if config.NO_REPEAT_INCLUDE_PROMPT else prompt_length
+        ))
+    return processors
+
+
+SENTENCE_ENDINGS = (".", "!", "?")
+CLOSING_PUNCTUATION = "\"'”’)"
+_SENTENCE_END = re.compile(r"[.!?]+[\"'”’)]*")
+
+
+def _ends_sentence(text: str) -> bool:
+    """Whether text ends with sentence punctuation (ignoring closing quotes/brackets)"""
+    text = text.rstrip().rstrip(CLOSING_PUNCTUATION)
+    return text.endswith(SENTENCE_ENDINGS)
+
+
+@lru_cache(maxsize=4)
+def _sentence_end_token_mask(tokenizer) -> torch.BoolTensor:
+    """Mask over the vocabulary of tokens that can finish a sentence"""
+    vocab_size = len(tokenizer)
+    mask = torch.zeros(vocab_size, dtype=torch.bool)
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(vocab_size)))):
+        if token and _ends_sentence(token):
+            mask[token_id] = True
+    return mask
+
+
+class SentenceBudgetCriteria(StoppingCriteria):
+    """
+    Stops a row at the first sentence boundary once its reply reaches `min_chars`
+
+    The reply is only decoded when the latest token can end a sentence, so
+    most decode steps cost a single mask lookup.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, min_chars):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.min_chars = min_chars  # One budget for every row, or a list with one per row (None = no budget)
+        self.sentence_end_mask = _sentence_end_token_mask(tokenizer)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if input_ids.shape[1] <= self.prompt_length:
+            return done
+
+        last_tokens = input_ids[:, -1].cpu()
+        candidates = self.sentence_end_mask[last_tokens.clamp(max=len(self.sentence_end_mask) - 1)]
+        for row in candidates.nonzero().flatten().tolist():
+            min_chars = self.min_chars[row] if isinstance(self.min_chars, (list, tuple)) else self.min_chars
+            if min_chars is None:
+                continue
+            reply = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True).strip()
+            done[row] = len(reply) >= min_chars and _ends_sentence(reply)
+        return done
+
+
+def trim_at_sentence_budget(text: str, min_chars) -> str:
+    """
+    Cut text after the first sentence end once it has `min_chars` characters
+
+    Where SentenceBudgetCriteria stops - for prompt lookup, which adds a whole
+    accepted draft per step, so the criteria only see the end of it.
+    """
+    if not min_chars:
+        return text
+    for match in _SENTENCE_END.finditer(text):
+        if len(text[:match.end()].strip()) >= min_chars:
+            return text[:match.end()]
+    return text
+
+
+def trim_at_stop_strings(text: str, stop_strings) -> str:
+    """Cut text at the first occurrence of any stop string"""
+    cut = len(text)
+    for stop_string in stop_strings:
+        index = text.find(stop_string)
+        if index != -1:
+            cut = min(cut, index)
+    return text[:cut]
+
+
+class StopStringFilter:
+    """
+    Holds back streamed text that might be the start of a stop string
+
+    Feed chunks in order; the returned text is safe to show. Once a stop
+    string has been seen, it and everything after it is dropped.
+    """
+
+    def __init__(self, stop_strings):
+        self.stop_strings = [stop_string for stop_string in stop_strings if stop_string]
+        self.buffer = ""
+        self.stopped = False
+
+    def feed(self, chunk: str) -> str:
+        if self.stopped:
+            return ""
+        self.buffer += chunk
+
+        trimmed = trim_at_stop_strings(self.buffer, self.stop_strings)
+        if len(trimmed) < len(self.buffer):
+            self.stopped = True
+            self.buffer = ""
+            return trimmed
+
+        # Keep back the longest tail that could still grow into a stop string
+        held = 0
+        for stop_string in self.stop_strings:
+            for length in range(min(len(stop_string) - 1, len(self.buffer)), held, -1):
+                if self.buffer.endswith(stop_string[:length]):
+                    held = length
+                    break
+        safe, self.buffer = self.buffer[:len(self.buffer) - held], self.buffer[len(self.buffer) - held:]
+        return safe
+
+    def flush(self) -> str:
+        """Release any held-back text once the stream has ended"""
+        remainder, self.buffer = ("" if self.stopped else self.buffer), ""
+        return remainder
+
+
+class SentenceBudgetFilter:
+    """
+    Cuts streamed text at the sentence end trim_at_sentence_budget would
+
+    Feed chunks in order; once the budget's sentence end has been passed,
+    everything after it is dropped.
+    """
+
+    def __init__(self, min_chars):
+        self.min_chars = min_chars
+        self.text = ""
+        self.stopped = False
+
+    def feed(self, chunk: str) -> str:
+        if self.stopped or not self.min_chars:
+            return "" if self.stopped else chunk
+        trimmed = trim_at_sentence_budget(self.text + chunk, self.min_chars)
+        self.stopped = len(trimmed) < len(self.text) + len(chunk)
+        chunk, self.text = trimmed[len(self.text):], trimmed
+        return chunk
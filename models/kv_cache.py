@@ -0,0 +1,118 @@
+"""
+Reusable key/value caches for prompt prefixes that repeat across turns
+"""
+import copy
+
+import torch
+from transformers.cache_utils import DynamicCache
+
+
+def _common_prefix_length(cached_ids: torch.LongTensor, input_ids: torch.LongTensor) -> int:
+    """Number of leading tokens two 1D id tensors have in common"""
+    length = min(len(cached_ids), len(input_ids))
+    if length == 0:
+        return 0
+    mismatches = (cached_ids[:length] != input_ids[:length]).nonzero()
+    return int(mismatches[0]) if len(mismatches) else length
+
+
+class PromptCache:
+    """
+    KV cache for a fixed prompt prefix (e.g. personality + case context)
+
+    Computed once per case by ModelManager.build_prefix_cache and reused on
+    every turn, so only the tokens after the prefix need to be prefilled.
+    """
+
+    def __init__(self, token_ids: torch.LongTensor, past_key_values: DynamicCache):
+        self.token_ids = token_ids  # 1D tensor of the cached prefix tokens
+        self.past_key_values = past_key_values
+
+    def __len__(self) -> int:
+        return len(self.token_ids)
+
+    def common_prefix_length(self, input_ids: torch.LongTensor) -> int:
+        """Number of leading tokens of `input_ids` (1D) that are already in the cache"""
+        return _common_prefix_length(self.token_ids, input_ids)
+
+    def fork(self, input_ids: torch.LongTensor):
+        """
+        Get a private copy of the cache that is valid for `input_ids` (1D)
+
+        Returns None if nothing can be reused. At least one prompt token is
+        always left uncached so the model has something to prefill.
+        """
+        reusable = min(self.common_prefix_length(input_ids), len(input_ids) - 1)
+        if reusable <= 0:
+            return None
+
+        past_key_values = copy.deepcopy(self.past_key_values)
+        if reusable < len(self.token_ids):
+            past_key_values.crop(reusable)
+        return past_key_values
+
+
+class SessionCache:
+    """
+    KV cache carried across turns of one conversation
+
+    Holds the tokens of the previous turn's prompt + reply. On the next turn it
+    is cropped in place to the longest prefix shared with the new prompt, so
+    only the tokens after the first change (e.g. a new RAG block or the latest
+    exchange) are prefilled. Falls back to the case's PromptCache whenever
+    that reuses more, and never holds more than `max_tokens` tokens.
+    """
+
+    def __init__(self, prefix_cache: PromptCache = None, max_tokens: int = 2048):
+        self.prefix_cache = prefix_cache
+        self.max_tokens = max_tokens
+        self.token_ids = torch.zeros(0, dtype=torch.long)
+        self.past_key_values = None
+
+    def __len__(self) -> int:
+        return len(self.token_ids)
+
+    def prepare(self, input_ids: torch.LongTensor) -> DynamicCache:
+        """
+        Crop the cache to what is still valid for `input_ids` (1D) and return it
+
+        The returned cache is updated in place by generate; call update() with
+        the generated sequence afterwards, or rollback() if generation failed.
+        """
+        limit = len(input_ids) - 1  # leave at least one token to prefill
+        reusable = 0
+        if self.past_key_values is not None:
+            reusable = min(_common_prefix_length(self.token_ids, input_ids), limit)
+
+        if self.prefix_cache is not None and min(self.prefix_cache.common_prefix_length(input_ids), limit) > reusable:
+            # Earlier turns diverged inside the static prefix - start again from it
+            self.past_key_values = self.prefix_cache.fork(input_ids)
+        elif reusable > 0:
+            self.past_key_values.crop(reusable)
+        else:
+            self.past_key_values = DynamicCache()
+
+        self.token_ids = input_ids[:self.past_key_values.get_seq_length()]
+        return self.past_key_values
+
+    def update(self, sequence: torch.LongTensor):
+        """Record the tokens the cache now holds after generating `sequence` (1D), evicting past the cap"""
+        cached = self.past_key_values.get_seq_length()
+        self.token_ids = sequence[:cached]
+        if cached > self.max_tokens:
+            self.past_key_values.crop(self.max_tokens)
+            self.token_ids = self.token_ids[:self.max_tokens]
+
+    def rollback(self):
+        """Drop anything a failed generation added beyond the recorded tokens"""
+        if self.past_key_values is None:
+            return
+        if len(self.token_ids):
+            self.past_key_values.crop(len(self.token_ids))
+        else:
+            self.past_key_values = None
+
+    def clear(self):
+        """Release the cached key/values"""
+        self.token_ids = self.token_ids[:0]
+        self.past_key_values = None
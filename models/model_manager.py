@@ -1,8 +1,33 @@
+import contextlib
+import hashlib
+import math
 import os
+import shutil
+from threading import Thread
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoModelForCausalLM,
+    StoppingCriteriaList,
+    StopStringCriteria,
+    TextIteratorStreamer,
+)
+from transformers.cache_utils import DynamicCache
+from huggingface_hub import snapshot_download
 from peft import PeftModel
 import config
+from models.generation import (
+    CancelGenerationCriteria,
+    repetition_processors,
+    SentenceBudgetCriteria,
+    SentenceBudgetFilter,
+    StopStringFilter,
+    trim_at_sentence_budget,
+    trim_at_stop_strings,
+)
+from models.kv_cache import PromptCache
+from models.registry import model_registry
+from models.scheduler import GenerationRequest
+from utils.tokenizer_cache import get_tokenizer
 
 
 class ModelManager:
@@ -12,66 +37,189 @@ class ModelManager:
         self.model = None
         self.tokenizer = None
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.last_generation_stats = {}
+        self._stop_string_criteria = {}  # Only used without a registry entry - see _get_stop_string_criteria
+        self._shared = None  # LoadedModel from the process-wide registry
 
-    def load_model(self, model_path="ScottBiggs2/tinyllama_detective_test", use_lora=False):
+    def load_model(self, model_path="ScottBiggs2/tinyllama_detective_test", use_lora=False, inference_mode=None,
+                   merge_lora=None):
         """
         Load a model from Hugging Face Hub or local path
 
         Args:
             model_path: Path to model on Hugging Face Hub (e.g., "username/model-name") or local path
             use_lora: Whether to load a LoRA fine-tuned model
+            inference_mode: "fp32" or "int8" (dynamic int8 Linear layers, CPU only) - defaults to config.CPU_INFERENCE_MODE
+            merge_lora: Fold the LoRA adapter into the base weights and cache the result on disk -
+                defaults to config.MERGE_LORA_ADAPTER
         """
+        if merge_lora is None:
+            merge_lora = config.MERGE_LORA_ADAPTER
+
+        inference_mode = inference_mode or config.CPU_INFERENCE_MODE
+        key = (model_path or config.DEFAULT_MODEL_NAME, use_lora, merge_lora, inference_mode, str(self.device))
+
+        # Every session asking for the same model shares one copy of the weights
+        self.release()
         try:
-            if model_path:
-                if use_lora:
-                    # Load base model first
-                    print("Loading base TinyLLaMA model")
-                    base_model_name = config.DEFAULT_MODEL_NAME
-                    self.tokenizer = AutoTokenizer.from_pretrained(base_model_name)
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                        base_model_name,
-                        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                        device_map="auto" if torch.cuda.is_available() else None
-                    )
-                    
-                    # Load LoRA adapter
-                    print(f"Loading LoRA adapter from {model_path}")
-                    self.model = PeftModel.from_pretrained(
-                        self.model, 
-                        model_path,
-                        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32
-                    )
-                    print("LoRA adapter loaded successfully")
-                else:
-                    # Load full model
-                    print(f"Loading model from {model_path}")
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                        model_path,
-                        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                        device_map="auto" if torch.cuda.is_available() else None
-                    )
-                    self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+            self._shared = model_registry.acquire(
+                key, lambda: self._load_weights(model_path, use_lora, inference_mode, merge_lora)
+            )
+        except Exception as e:
+            print(f"Error loading model: {str(e)}")
+            raise
+
+        self.model = self._shared.model
+        self.tokenizer = self._shared.tokenizer
+        print(f"Model loaded on device: {self.device}")
+        return self
+
+    def release(self):
+        """Hand the shared model back to the registry"""
+        if self._shared is not None:
+            model_registry.release(self._shared)
+            self._shared = None
+            self.model = None
+            self.tokenizer = None
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+    def _load_weights(self, model_path, use_lora, inference_mode, merge_lora):
+        """Actually load model + tokenizer - only called by the registry when nobody has them loaded"""
+        if model_path:
+            if use_lora and merge_lora:
+                self._load_merged_lora_model(config.DEFAULT_MODEL_NAME, model_path)
+            elif use_lora:
+                # Load base model first
+                print("Loading base TinyLLaMA model")
+                base_model_name = config.DEFAULT_MODEL_NAME
+                self.tokenizer = get_tokenizer(base_model_name)
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    base_model_name,
+                    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+                    device_map="auto" if torch.cuda.is_available() else None
+                )
+                
+                # Load LoRA adapter
+                print(f"Loading LoRA adapter from {model_path}")
+                self.model = PeftModel.from_pretrained(
+                    self.model, 
+                    model_path,
+                    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32
+                )
+                print("LoRA adapter loaded successfully")
             else:
-                # Load default TinyLLaMA model
-                print("Loading default TinyLLaMA model")
-                model_name = config.DEFAULT_MODEL_NAME
-                self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+                # Load full model
+                print(f"Loading model from {model_path}")
                 self.model = AutoModelForCausalLM.from_pretrained(
-                    model_name,
+                    model_path,
                     torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
                     device_map="auto" if torch.cuda.is_available() else None
                 )
+                self.tokenizer = get_tokenizer(model_path)
+        else:
+            # Load default TinyLLaMA model
+            print("Loading default TinyLLaMA model")
+            model_name = config.DEFAULT_MODEL_NAME
+            self.tokenizer = get_tokenizer(model_name)
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+                device_map="auto" if torch.cuda.is_available() else None
+            )
 
-            # Set pad token if not present
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
+        self._apply_inference_mode(inference_mode)
+        return self.model, self.tokenizer
 
-            print(f"Model loaded on device: {self.device}")
-            return self
-            
-        except Exception as e:
-            print(f"Error loading model: {str(e)}")
-            raise
+    def _load_merged_lora_model(self, base_model_name, adapter_path):
+        """
+        Load base model + LoRA adapter as one merged model
+
+        The merged weights are saved as a safetensors snapshot keyed by a hash
+        of the base model, dtype and adapter files, so later starts load the
+        snapshot directly instead of assembling base + adapter again.
+        """
+        dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+        adapter_dir = adapter_path if os.path.isdir(adapter_path) else snapshot_download(
+            adapter_path, allow_patterns=["adapter_config.json", "adapter_model.*"]
+        )
+        snapshot_path = os.path.join(
+            config.MERGED_MODEL_CACHE_DIR,
+            f"{os.path.basename(adapter_path.rstrip('/'))}-{self._adapter_hash(base_model_name, adapter_dir, dtype)}"
+        )
+
+        if os.path.isfile(os.path.join(snapshot_path, "config.json")):
+            print(f"Loading merged LoRA model from {snapshot_path}")
+            self.tokenizer = get_tokenizer(snapshot_path)
+            self.model = AutoModelForCausalLM.from_pretrained(
+                snapshot_path,
+                torch_dtype=dtype,
+                device_map="auto" if torch.cuda.is_available() else None
+            )
+            return
+
+        print("Loading base TinyLLaMA model")
+        self.tokenizer = get_tokenizer(base_model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(
+            base_model_name,
+            torch_dtype=dtype,
+            device_map="auto" if torch.cuda.is_available() else None
+        )
+        print(f"Merging LoRA adapter from {adapter_path}")
+        self.model = PeftModel.from_pretrained(self.model, adapter_dir, torch_dtype=dtype).merge_and_unload()
+
+        # Write to a temporary directory first so an interrupted save is never picked up
+        partial_path = f"{snapshot_path}.partial-{os.getpid()}"
+        shutil.rmtree(partial_path, ignore_errors=True)
+        self.model.save_pretrained(partial_path, safe_serialization=True)
+        self.tokenizer.save_pretrained(partial_path)
+        try:
+            os.replace(partial_path, snapshot_path)
+            print(f"Merged LoRA model saved to {snapshot_path}")
+        except OSError:
+            # Another process saved the same snapshot first
+            shutil.rmtree(partial_path, ignore_errors=True)
+
+    @staticmethod
+    def _adapter_hash(base_model_name, adapter_dir, dtype):
+        """Short content hash identifying a merged base model + adapter"""
+        digest = hashlib.sha256(f"{base_model_name}|{dtype}".encode())
+        for filename in sorted(os.listdir(adapter_dir)):
+            if filename == "adapter_config.json" or filename.startswith("adapter_model."):
+                digest.update(filename.encode())
+                with open(os.path.join(adapter_dir, filename), "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+        return digest.hexdigest()[:16]
+
+    def _apply_inference_mode(self, inference_mode):
+        """
+        Convert the loaded model for the requested CPU inference mode
+
+        "int8" folds any LoRA adapter into the base weights (quantized Linear
+        layers can't host the adapter's extra matmuls) and then swaps every
+        Linear layer for a dynamically quantized int8 one.
+        """
+        if inference_mode == "fp32":
+            return
+        if inference_mode != "int8":
+            raise ValueError(f"Unknown inference mode: {inference_mode}")
+        if self.device.type != "cpu":
+            print(f"int8 inference is CPU only - keeping the full precision model on {self.device}")
+            return
+
+        if isinstance(self.model, PeftModel):
+            print("Merging LoRA adapter into the base weights for quantization")
+            self.model = self.model.merge_and_unload()
+
+        print("Quantizing Linear layers to dynamic int8")
+        self.model = torch.ao.quantization.quantize_dynamic(
+            self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
 
     def save_custom_model(self, save_path):
         """
@@ -91,41 +239,321 @@ class ModelManager:
 
         print(f"Model saved to {save_path}")
 
-    def generate_response(self, prompt, max_length=200, temperature=0.7):
+    def build_prefix_cache(self, prefix):
         """
-        Generate text response from the model
+        Prefill a fixed prompt prefix once and keep its key/value cache
 
         Args:
-            prompt: Input text
-            max_length: Maximum response length
-            temperature: Sampling temperature
+            prefix: Text every later prompt starts with (e.g. personality + case context)
+
+        Returns:
+            PromptCache to pass as `prefix_cache` to generate_response
         """
         if self.model is None:
             raise ValueError("No model loaded")
 
+        inputs = self.tokenizer.encode(prefix, return_tensors="pt")
+        inputs = inputs.to(self.device)
+
+        with self._model_lock(), torch.no_grad():
+            outputs = self.model(inputs, past_key_values=DynamicCache(), use_cache=True)
+
+        print(f"Cached {len(inputs[0])} prefix tokens")
+        return PromptCache(inputs[0], outputs.past_key_values)
+
+    def get_prefix_cache(self, prefix):
+        """
+        The PromptCache for `prefix`, shared by every session using the same loaded model
+
+        Built on first use. Generation only ever forks it, so sessions playing
+        the same case share one prefill and one copy of its key/values.
+
+        Args:
+            prefix: Text every later prompt starts with (e.g. personality + case context)
+
+        Returns:
+            PromptCache to pass as `prefix_cache` to generate_response
+        """
+        if self._shared is None:
+            return self.build_prefix_cache(prefix)
+
+        with self._shared.prefix_lock:
+            prefix_cache = self._shared.prefix_caches.get(prefix)
+            if prefix_cache is None:
+                prefix_cache = self._shared.prefix_caches[prefix] = self.build_prefix_cache(prefix)
+        return prefix_cache
+
+    def input_embeddings(self):
+        """The model's token embedding table (vocab x hidden), or None if no model is loaded"""
+        if self.model is None:
+            return None
+        return self.model.get_input_embeddings().weight
+
+    def _model_lock(self):
+        """Serializes use of the weights with every other session sharing them"""
+        return self._shared.lock if self._shared is not None else contextlib.nullcontext()
+
+    def set_batching(self, enabled):
+        """Turn the batching scheduler on or off for the shared model - this affects every session using it"""
+        if self._shared is None:
+            raise ValueError("No model loaded")
+        if enabled:
+            self._shared.start_scheduler()
+        else:
+            self._shared.stop_scheduler()
+
+    def _batching(self):
+        """Whether generate calls go through the shared model's batching scheduler"""
+        return self._shared is not None and self._shared.scheduler is not None
+
+    def _submit_batched(self, prompt, max_length, temperature, stop_strings, max_chars, sentence_budget,
+                        streamer=None):
+        """Queue a request on the batching scheduler - batched rows don't use KV caches"""
+        inputs = self.tokenizer.encode(prompt, return_tensors="pt")[0]
+        request = GenerationRequest(
+            inputs,
+            max_new_tokens=self._token_budget(max_length, max_chars, len(inputs)),
+            temperature=temperature,
+            stop_strings=stop_strings,
+            sentence_budget=sentence_budget,
+            timeout=config.BATCH_REQUEST_TIMEOUT,
+            streamer=streamer
+        )
+        return self._shared.scheduler.submit(request)
+
+    def _record_batched(self, result):
+        self.last_generation_stats = {
+            "prompt_tokens": result.prompt_tokens,
+            "cached_tokens": 0,
+            "generated_tokens": result.generated_tokens,
+            "batch_size": result.batch_size,
+        }
+
+    def _token_budget(self, max_length, max_chars, prompt_tokens):
+        """Never decode more tokens than could survive a character limit, or than fit in the model's context"""
+        if max_chars:
+            max_length = min(max_length, math.ceil(max_chars / config.MIN_CHARS_PER_TOKEN))
+
+        context_size = getattr(self.model.config, "max_position_embeddings", None)
+        if context_size:
+            if prompt_tokens >= context_size:
+                raise ValueError(f"Prompt is {prompt_tokens} tokens, the model's context is only {context_size}")
+            max_length = min(max_length, context_size - prompt_tokens)
+        return max_length
+
+    def _get_stop_string_criteria(self, stop_strings):
+        """StopStringCriteria preprocess the whole vocabulary, so build one per set of stop strings"""
+        if self._shared is not None:
+            return self._shared.get_stop_string_criteria(stop_strings)  # Shared by every session on the model
+        key = tuple(stop_strings)
+        if key not in self._stop_string_criteria:
+            self._stop_string_criteria[key] = StopStringCriteria(self.tokenizer, list(key))
+        return self._stop_string_criteria[key]
+
+    @staticmethod
+    def _trim_budget(generation_kwargs, sentence_budget):
+        """The sentence budget to trim the reply to afterwards - only needed when drafts skip per-token checks"""
+        return sentence_budget if "prompt_lookup_num_tokens" in generation_kwargs else None
+
+    def _prepare_generation(self, prompt, max_length, temperature, prefix_cache=None, session_cache=None,
+                            stop_strings=None, max_chars=None, sentence_budget=None):
+        """Tokenize the prompt and build the keyword arguments shared by all generate calls"""
+        if self.model is None:
+            raise ValueError("No model loaded")
+
         # Tokenize input
         inputs = self.tokenizer.encode(prompt, return_tensors="pt")
         inputs = inputs.to(self.device)
 
+        max_length = self._token_budget(max_length, max_chars, len(inputs[0]))
+
+        stopping_criteria = StoppingCriteriaList()
+        if stop_strings:
+            stopping_criteria.append(self._get_stop_string_criteria(stop_strings))
+        if sentence_budget:
+            stopping_criteria.append(SentenceBudgetCriteria(self.tokenizer, len(inputs[0]), sentence_budget))
+
+        generation_kwargs = dict(
+            max_length=len(inputs[0]) + max_length,
+            temperature=temperature,
+            do_sample=True,
+            pad_token_id=self.tokenizer.eos_token_id,
+            logits_processor=repetition_processors(len(inputs[0])),
+            stopping_criteria=stopping_criteria
+        )
+
+        # Draft continuations by copying n-grams from the prompt (RAG evidence, earlier turns) and verify
+        # them in one forward pass - accepted drafts save decode steps, and the output distribution is unchanged
+        # Stop strings and the sentence budget are then only checked at the end of each accepted draft,
+        # so the reply is trimmed to them afterwards as well (see _trim_budget)
+        if config.PROMPT_LOOKUP_NUM_TOKENS:
+            generation_kwargs["prompt_lookup_num_tokens"] = config.PROMPT_LOOKUP_NUM_TOKENS
+            generation_kwargs["max_matching_ngram_size"] = config.PROMPT_LOOKUP_MAX_NGRAM
+
+        # Reuse already prefilled tokens so only the rest of the prompt is encoded
+        past_key_values = None
+        if session_cache is not None:
+            past_key_values = session_cache.prepare(inputs[0])
+        elif prefix_cache is not None:
+            past_key_values = prefix_cache.fork(inputs[0])
+        if past_key_values is not None:
+            generation_kwargs["past_key_values"] = past_key_values
+            generation_kwargs["attention_mask"] = torch.ones_like(inputs)
+
+        self.last_generation_stats = {
+            "prompt_tokens": len(inputs[0]),
+            "cached_tokens": past_key_values.get_seq_length() if past_key_values is not None else 0,
+        }
+        return inputs, generation_kwargs
+
+    def _generate(self, inputs, generation_kwargs, session_cache=None, **extra_kwargs):
+        """Run model.generate and keep the session cache in step with what it holds"""
+        try:
+            with self._model_lock(), torch.no_grad():
+                outputs = self.model.generate(inputs, **generation_kwargs, **extra_kwargs)
+        except Exception:
+            if session_cache is not None:
+                session_cache.rollback()
+            raise
+
+        if session_cache is not None:
+            session_cache.update(outputs[0])
+        self.last_generation_stats["generated_tokens"] = outputs.shape[1] - inputs.shape[1]
+        return outputs
+
+    def generate_response(self, prompt, max_length=200, temperature=0.7, prefix_cache=None, session_cache=None,
+                          stop_strings=None, max_chars=None, sentence_budget=None):
+        """
+        Generate text response from the model
+
+        Args:
+            prompt: Input text
+            max_length: Maximum response length
+            temperature: Sampling temperature
+            prefix_cache: Optional PromptCache for the start of the prompt
+            session_cache: Optional SessionCache carried across turns (updated in place)
+            stop_strings: Strings (e.g. speaker tags) that end the response; they are not returned
+            max_chars: Character limit the caller will truncate to - caps max_length accordingly
+            sentence_budget: Stop at the first sentence end once the response has this many characters
+        """
+        if self._batching():
+            request = self._submit_batched(prompt, max_length, temperature, stop_strings, max_chars, sentence_budget)
+            result = request.future.result()
+            self._record_batched(result)
+            return result.text
+
+        inputs, generation_kwargs = self._prepare_generation(
+            prompt, max_length, temperature, prefix_cache, session_cache,
+            stop_strings, max_chars, sentence_budget
+        )
+
         # Generate response
-        with torch.no_grad():
-            outputs = self.model.generate(
-                inputs,
-                max_length=len(inputs[0]) + max_length,
-                temperature=temperature,
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id,
-                no_repeat_ngram_size=2
-            )
+        outputs = self._generate(inputs, generation_kwargs, session_cache)
 
         # Decode response (excluding the input prompt)
         response = self.tokenizer.decode(
             outputs[0][len(inputs[0]):],
             skip_special_tokens=True
         )
+        if stop_strings:
+            response = trim_at_stop_strings(response, stop_strings)
+        response = trim_at_sentence_budget(response, self._trim_budget(generation_kwargs, sentence_budget))
 
         return response.strip()
 
+    def generate_response_stream(self, prompt, max_length=200, temperature=0.7, prefix_cache=None, session_cache=None,
+                                 stop_strings=None, max_chars=None, sentence_budget=None):
+        """
+        Generate text response from the model, yielding text as it is decoded
+
+        Generation runs on a background thread and is cancelled if the caller
+        stops iterating early.
+
+        Args:
+            prompt: Input text
+            max_length: Maximum response length
+            temperature: Sampling temperature
+            prefix_cache: Optional PromptCache for the start of the prompt
+            session_cache: Optional SessionCache carried across turns (updated in place)
+            stop_strings: Strings (e.g. speaker tags) that end the response; they are never yielded
+            max_chars: Character limit the caller will truncate to - caps max_length accordingly
+            sentence_budget: Stop at the first sentence end once the response has this many characters
+
+        Yields:
+            str: Chunks of newly decoded text (excluding the input prompt)
+        """
+        if self._batching():
+            yield from self._stream_batched(prompt, max_length, temperature, stop_strings, max_chars, sentence_budget)
+            return
+
+        inputs, generation_kwargs = self._prepare_generation(
+            prompt, max_length, temperature, prefix_cache, session_cache,
+            stop_strings, max_chars, sentence_budget
+        )
+
+        streamer = TextIteratorStreamer(
+            self.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=config.STREAM_TIMEOUT
+        )
+        cancel = CancelGenerationCriteria()
+        generation_kwargs["stopping_criteria"].append(cancel)
+        stop_filter = StopStringFilter(stop_strings or [])
+        budget_filter = SentenceBudgetFilter(self._trim_budget(generation_kwargs, sentence_budget))
+        errors = []
+
+        def _run():
+            try:
+                self._generate(inputs, generation_kwargs, session_cache, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = Thread(target=_run, daemon=True)
+        thread.start()
+        try:
+            for chunk in streamer:
+                chunk = budget_filter.feed(stop_filter.feed(chunk))
+                if chunk:
+                    yield chunk
+                if budget_filter.stopped:
+                    break
+            remainder = budget_filter.feed(stop_filter.flush())
+            if remainder:
+                yield remainder
+        finally:
+            cancel.cancel()
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def _stream_batched(self, prompt, max_length, temperature, stop_strings, max_chars, sentence_budget):
+        """generate_response_stream for a request decoded as one row of a scheduled batch"""
+        streamer = TextIteratorStreamer(
+            self.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=config.STREAM_TIMEOUT
+        )
+        request = self._submit_batched(
+            prompt, max_length, temperature, stop_strings, max_chars, sentence_budget, streamer=streamer
+        )
+        stop_filter = StopStringFilter(stop_strings or [])
+        try:
+            for chunk in streamer:
+                chunk = stop_filter.feed(chunk)
+                if chunk:
+                    yield chunk
+            remainder = stop_filter.flush()
+            if remainder:
+                yield remainder
+        finally:
+            request.cancel()
+
+        self._record_batched(request.future.result())
+
     def edit_model_for_detective_game(self):
         """
         This is where you'll implement your model editing logic
@@ -0,0 +1,160 @@
+"""
+Process-wide registry of loaded models, shared by every ModelManager (and so every Streamlit session)
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import StopStringCriteria
+
+import config
+from models.scheduler import GenerationScheduler
+
+
+def _tensor_bytes(value) -> int:
+    """Bytes held by a state-dict value (quantized layers store tuples of tensors)"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(item) for item in value)
+    return 0
+
+
+class LoadedModel:
+    """One loaded model + tokenizer, shared by every ModelManager that asked for the same key"""
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.model = None
+        self.tokenizer = None
+        self.size_bytes = 0
+        self.ref_count = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()  # One generate call at a time on the shared weights
+        self.ready = threading.Event()
+        self.error = None
+        self.scheduler = None  # GenerationScheduler batching concurrent requests, when enabled
+        self.prefix_caches = {}  # Prompt prefix (personality + case context) -> PromptCache, read-only once built
+        self.prefix_lock = threading.Lock()  # So concurrent sessions starting a case prefill it once
+        self._stop_string_criteria = {}  # Stop strings -> StopStringCriteria, shared by every session and the scheduler
+        self._stop_string_lock = threading.Lock()
+
+    def get_stop_string_criteria(self, stop_strings) -> StopStringCriteria:
+        """StopStringCriteria preprocess the whole vocabulary, so build one per set of stop strings and model"""
+        key = tuple(stop_strings)
+        with self._stop_string_lock:
+            if key not in self._stop_string_criteria:
+                self._stop_string_criteria[key] = StopStringCriteria(self.tokenizer, list(key))
+            return self._stop_string_criteria[key]
+
+    def start_scheduler(self):
+        """Route generate calls for this model through a batching scheduler"""
+        if self.scheduler is None:
+            self.scheduler = GenerationScheduler(
+                self.model, self.tokenizer, self.lock,
+                max_batch_size=config.BATCH_MAX_SIZE,
+                batch_window=config.BATCH_WINDOW_MS / 1000,
+                get_stop_string_criteria=self.get_stop_string_criteria
+            )
+
+    def stop_scheduler(self):
+        """Go back to one generate call per request"""
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+            self.scheduler = None
+
+
+class ModelRegistry:
+    """
+    Loads each (model path, adapter, dtype, mode) combination at most once per process
+
+    Entries are reference counted. Idle entries (no references) stay loaded
+    for reuse until the memory ceiling forces them out, least recently used
+    first.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes  # 0 means no ceiling
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: tuple, loader) -> LoadedModel:
+        """
+        Get the shared model for `key`, loading it with `loader()` if needed
+
+        Args:
+            key: Hashable description of the model (path, adapter, dtype, ...)
+            loader: Callable returning (model, tokenizer), only called on a miss
+
+        Returns:
+            LoadedModel - hand it back with release() when done
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            is_loader = entry is None
+            if is_loader:
+                entry = LoadedModel(key)
+                self._entries[key] = entry
+            entry.ref_count += 1
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(key)
+
+        if not is_loader:
+            entry.ready.wait()
+            if entry.error is not None:
+                self.release(entry)
+                raise entry.error
+            print(f"Reusing loaded model {key[0]} ({entry.ref_count} sessions)")
+            return entry
+
+        try:
+            entry.model, entry.tokenizer = loader()
+            if config.BATCH_SCHEDULER_ENABLED:
+                entry.start_scheduler()
+            entry.size_bytes = sum(_tensor_bytes(value) for value in entry.model.state_dict().values())
+            with self._lock:
+                # The new entry is already counted in total_bytes()
+                self._evict_idle(self.max_bytes)
+                if self.max_bytes and self.total_bytes() > self.max_bytes:
+                    raise MemoryError(
+                        f"Loading {key[0]} needs {entry.size_bytes / 2**30:.1f} GB, which exceeds the "
+                        f"{self.max_bytes / 2**30:.1f} GB model memory limit with the models in use"
+                    )
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                self._entries.pop(key, None)
+            entry.stop_scheduler()
+            entry.model = entry.tokenizer = None
+            raise
+        finally:
+            entry.ready.set()
+
+        print(f"Registered model {key[0]} ({entry.size_bytes / 2**30:.2f} GB)")
+        return entry
+
+    def release(self, entry: LoadedModel):
+        """Drop one reference; the model stays cached until memory is needed"""
+        with self._lock:
+            entry.ref_count = max(entry.ref_count - 1, 0)
+            entry.last_used = time.monotonic()
+
+    def total_bytes(self) -> int:
+        """Estimated memory held by all loaded models"""
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def _evict_idle(self, target_bytes: int):
+        """Unload least recently used idle models until the total is at most target_bytes (caller holds the lock)"""
+        if not self.max_bytes:
+            return
+        for key, entry in list(self._entries.items()):
+            if self.total_bytes() <= target_bytes:
+                break
+            if entry.ref_count == 0 and entry.ready.is_set():
+                print(f"Unloading idle model {key[0]}")
+                entry.stop_scheduler()
+                del self._entries[key]
+
+
+model_registry = ModelRegistry(max_bytes=int(config.MODEL_MEMORY_LIMIT_GB * 2**30))
@@ -0,0 +1,305 @@
+"""
+Request-batching scheduler - merges concurrent players' generate calls into padded batches
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, StopStringCriteria
+from transformers.generation.streamers import BaseStreamer
+
+from models.generation import SentenceBudgetCriteria, repetition_processors, trim_at_stop_strings
+
+
+@dataclass
+class GenerationResult:
+    """What a caller gets back for one scheduled request"""
+    text: str
+    prompt_tokens: int
+    generated_tokens: int
+    batch_size: int
+    timed_out: bool = False
+
+
+class GenerationRequest:
+    """One caller's prompt plus its own limits; `future` resolves to a GenerationResult"""
+
+    def __init__(self, input_ids: torch.LongTensor, max_new_tokens: int, temperature: float,
+                 stop_strings=None, sentence_budget: Optional[int] = None, timeout: float = 120,
+                 streamer: Optional[BaseStreamer] = None):
+        self.input_ids = input_ids  # 1D prompt tokens
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.stop_strings = tuple(stop_strings or ())
+        self.sentence_budget = sentence_budget
+        self.deadline = time.monotonic() + timeout
+        self.streamer = streamer
+        self.future = Future()
+        self.cancelled = threading.Event()
+        self.deadline_step = None  # Tokens generated in the batch when the deadline passed
+
+    def cancel(self):
+        """Stop this request's row at the next decode step (the rest of the batch carries on)"""
+        self.cancelled.set()
+
+    @property
+    def batch_key(self) -> tuple:
+        """Requests can only share a generate call if their sampling settings match"""
+        return (self.temperature, self.stop_strings)
+
+
+class _RequestLimitsCriteria(StoppingCriteria):
+    """Per-row token limits, deadlines and cancellation for a batch of requests"""
+
+    def __init__(self, requests: List[GenerationRequest], prompt_length: int):
+        self.requests = requests
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = input_ids.shape[1] - self.prompt_length
+        now = time.monotonic()
+        done = []
+        for request in self.requests:
+            if now >= request.deadline and request.deadline_step is None:
+                request.deadline_step = generated
+            done.append(
+                generated >= request.max_new_tokens or request.deadline_step is not None or request.cancelled.is_set()
+            )
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class _BatchStreamer(BaseStreamer):
+    """Fans a batched generate's tokens out to each streaming request's own streamer"""
+
+    def __init__(self, streamers: List[Optional[BaseStreamer]]):
+        self.streamers = streamers
+        self.ended = [streamer is None for streamer in streamers]
+
+    def put(self, value):
+        for row, streamer in enumerate(self.streamers):
+            if not self.ended[row]:
+                # The first call carries the prompts [batch, length], later ones one token per row [batch]
+                streamer.put(value[row] if value.dim() > 1 else value[row:row + 1])
+
+    def end_rows(self, done: torch.BoolTensor):
+        """End the streams of rows that just stopped - the rest of the batch may decode for a while yet"""
+        for row in done.nonzero().flatten().tolist():
+            if not self.ended[row]:
+                self.ended[row] = True
+                self.streamers[row].end()
+
+    def end(self):
+        for row, streamer in enumerate(self.streamers):
+            if not self.ended[row]:
+                self.ended[row] = True
+                streamer.end()
+
+
+class _RowStopCriteria(StoppingCriteria):
+    """
+    All of a batch's stop conditions as one criterion, so it knows when each row is done
+
+    generate() only ORs its criteria together, so a row's stream would
+    otherwise stay open until the longest row finished.
+    """
+
+    def __init__(self, criteria: List[StoppingCriteria], eos_token_id: Optional[int],
+                 streamer: Optional[_BatchStreamer]):
+        self.criteria = criteria
+        self.eos_token_id = eos_token_id
+        self.streamer = streamer
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.eos_token_id is not None:
+            done |= input_ids[:, -1] == self.eos_token_id
+        for criteria in self.criteria:
+            done |= criteria(input_ids, scores, **kwargs)
+        if self.streamer is not None:
+            # Runs right after the step's tokens were streamed, so each row's last token is already out
+            self.streamer.end_rows(done)
+        return done
+
+
+class GenerationScheduler:
+    """
+    Queue + worker thread in front of one shared model
+
+    Requests that arrive within `batch_window` seconds of each other (up to
+    `max_batch_size`) and share sampling settings are left-padded into one
+    batch and decoded by a single generate call. Each row stops on its own
+    token limit, stop strings, sentence budget, deadline or cancellation.
+    Requests still queued when their deadline passes fail with TimeoutError;
+    requests that run out of time mid-batch return what they have with
+    `timed_out` set. Requests submitted after shutdown() fail with
+    RuntimeError.
+    """
+
+    def __init__(self, model, tokenizer, model_lock: threading.Lock, max_batch_size: int = 8,
+                 batch_window: float = 0.02, get_stop_string_criteria: Callable = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_lock = model_lock
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self._queue = queue.Queue()
+        self._closed = False
+        self._closed_lock = threading.Lock()  # So no request can be queued behind the shutdown marker
+        self._stop_string_criteria = {}
+        # Stop strings -> StopStringCriteria, e.g. the loaded model's cache shared with its sessions
+        self._get_stop_string_criteria = get_stop_string_criteria or self._build_stop_string_criteria
+        self._worker = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """Queue a request; wait on request.future (or iterate its streamer) for the result"""
+        with self._closed_lock:
+            if not self._closed:
+                self._queue.put(request)
+                return request
+        self._fail(request, RuntimeError("Generation scheduler has been shut down"))
+        return request
+
+    def shutdown(self):
+        """Stop the worker once the queued requests are done - later submissions fail right away"""
+        with self._closed_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def _build_stop_string_criteria(self, stop_strings) -> StopStringCriteria:
+        """StopStringCriteria preprocess the whole vocabulary, so build one per set of stop strings"""
+        if stop_strings not in self._stop_string_criteria:
+            self._stop_string_criteria[stop_strings] = StopStringCriteria(self.tokenizer, list(stop_strings))
+        return self._stop_string_criteria[stop_strings]
+
+    @staticmethod
+    def _fail(request: GenerationRequest, error: Exception):
+        """Resolve a request with an error and end its stream, so no caller is left waiting"""
+        request.future.set_exception(error)
+        if request.streamer is not None:
+            request.streamer.end()
+
+    def _run(self):
+        try:
+            self._serve()
+        finally:
+            # Whether shut down or crashed, nothing left in the queue will be served
+            with self._closed_lock:
+                self._closed = True
+            while True:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    self._fail(request, RuntimeError("Generation scheduler stopped before serving this request"))
+
+    def _serve(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch, stopping = [first], False
+            window_ends = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                remaining = window_ends - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.batch_key, []).append(request)
+            for requests in groups.values():
+                self._run_batch(requests)
+
+            if stopping:
+                return
+
+    def _run_batch(self, requests: List[GenerationRequest]):
+        now = time.monotonic()
+        live = []
+        for request in requests:
+            if request.cancelled.is_set() or now >= request.deadline:
+                self._fail(request, TimeoutError("Generation request expired before it was scheduled"))
+            else:
+                live.append(request)
+        if not live:
+            return
+
+        try:
+            results = self._generate(live)
+        except Exception as e:
+            for request in live:
+                self._fail(request, e)
+            return
+
+        for request, result in zip(live, results):
+            request.future.set_result(result)
+
+    def _generate(self, requests: List[GenerationRequest]) -> List[GenerationResult]:
+        """Left-pad the prompts and decode them in one generate call"""
+        pad_token_id = self.tokenizer.pad_token_id
+        prompt_length = max(len(request.input_ids) for request in requests)
+        input_ids = torch.full((len(requests), prompt_length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, request in enumerate(requests):
+            input_ids[row, prompt_length - len(request.input_ids):] = request.input_ids
+            attention_mask[row, prompt_length - len(request.input_ids):] = 1
+
+        device = self.model.device
+        criteria = [_RequestLimitsCriteria(requests, prompt_length)]
+        stop_strings = requests[0].stop_strings
+        if stop_strings:
+            criteria.append(self._get_stop_string_criteria(stop_strings))
+        if any(request.sentence_budget for request in requests):
+            criteria.append(SentenceBudgetCriteria(
+                self.tokenizer, prompt_length, [request.sentence_budget for request in requests]
+            ))
+
+        streamers = [request.streamer for request in requests]
+        batch_streamer = _BatchStreamer(streamers) if any(streamers) else None
+        stopping_criteria = StoppingCriteriaList([
+            _RowStopCriteria(criteria, self.tokenizer.eos_token_id, batch_streamer)
+        ])
+        with self.model_lock, torch.no_grad():
+            outputs = self.model.generate(
+                input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+                max_new_tokens=max(request.max_new_tokens for request in requests),
+                temperature=requests[0].temperature,
+                do_sample=True,
+                pad_token_id=pad_token_id,
+                logits_processor=repetition_processors(prompt_length),
+                stopping_criteria=stopping_criteria,
+                streamer=batch_streamer
+            )
+
+        results = []
+        for row, request in enumerate(requests):
+            generated = outputs[row, prompt_length:prompt_length + request.max_new_tokens]
+            # Rows that stopped early are padded out to the longest row
+            generated_tokens = int((generated != pad_token_id).sum())
+            text = self.tokenizer.decode(generated, skip_special_tokens=True)
+            results.append(GenerationResult(
+                text=trim_at_stop_strings(text, request.stop_strings).strip(),
+                prompt_tokens=len(request.input_ids),
+                generated_tokens=generated_tokens,
+                batch_size=len(requests),
+                # Still decoding when the deadline passed, rather than having finished before it
+                timed_out=request.deadline_step is not None and generated_tokens >= request.deadline_step
+            ))
+        return results
@@ -0,0 +1,44 @@
+"""
+CaseDocumentManager discovery and retrieval bookkeeping, without a model
+"""
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+from data.case_manager import CaseDocumentManager
+
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch):
+    monkeypatch.chdir(REPO_ROOT)  # Case data paths are relative to the repo
+
+
+def test_solution_indexed_once_however_often_named():
+    manager = CaseDocumentManager("seaside_cottage")
+    snapshot = manager.snapshot()
+
+    for _ in range(3):
+        manager.process_input("Clara surprised Hugo in the attic")
+    version = manager.rag_system.discovery_version
+    manager.process_input("So it was Hugo in the attic with Clara")
+
+    assert [doc.id for doc in manager.rag_system._added] == ["solution"]
+    assert manager.rag_system.discovery_version == version  # Nothing new, so cached contexts stay valid
+
+    manager.restore(snapshot)
+    assert manager.rag_system._added == ()
+    manager.process_input("Clara surprised Hugo in the attic")
+    assert [doc.id for doc in manager.rag_system._added] == ["solution"]
+
+
+def test_clue_discovered_once():
+    manager = CaseDocumentManager("seaside_cottage")
+
+    first, _ = manager.process_input("Who were the guests at the cottage last night?")
+    again, _ = manager.process_input("Tell me about the guests again")
+
+    assert first and not again
+    assert len(manager.get_discovered_documents()) == len(first)
@@ -0,0 +1,65 @@
+"""
+ChatLog: bounded in-memory history with older messages spilled to disk
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.chat_log import ChatLog
+
+
+def fill(chat_log, count):
+    messages = []
+    for i in range(count):
+        message = ("user" if i % 2 == 0 else "assistant", f"message {i} é", ("guest_list",) if i % 3 == 0 else ())
+        chat_log.append(*message)
+        messages.append(message)
+    return messages
+
+
+def test_latest_reads_spilled_messages(tmp_path):
+    chat_log = ChatLog(max_in_memory=5, spill_dir=str(tmp_path))
+    messages = fill(chat_log, 23)
+
+    assert len(chat_log) == 23
+    for count in (1, 5, 6, 12, 23, 100):
+        assert chat_log.latest(count) == messages[-count:]
+
+
+def test_pop_pulls_spilled_messages_back(tmp_path):
+    chat_log = ChatLog(max_in_memory=5, spill_dir=str(tmp_path))
+    messages = fill(chat_log, 23)
+
+    chat_log.pop(8)
+    chat_log.append("user", "again")
+
+    assert chat_log.latest(100) == messages[:15] + [("user", "again", ())]
+
+
+def test_undo_turn_drops_an_interrupted_turn(tmp_path):
+    chat_log = ChatLog(max_in_memory=2, spill_dir=str(tmp_path))
+    chat_log.start_turn()
+    chat_log.append("user", "Who was at the cottage?")
+    chat_log.append("assistant", "Lady Agatha and her guests.")
+    chat_log.start_turn()
+    chat_log.append("user", "And the sword?")  # Reply interrupted - never written
+
+    chat_log.undo_turn()
+    assert chat_log.latest(10) == [("user", "Who was at the cottage?", ()),
+                                   ("assistant", "Lady Agatha and her guests.", ())]
+    chat_log.undo_turn()
+    assert len(chat_log) == 0
+    chat_log.undo_turn()  # Nothing left to undo
+    assert len(chat_log) == 0
+
+
+def test_clear_deletes_spill_file(tmp_path):
+    chat_log = ChatLog(max_in_memory=2, spill_dir=str(tmp_path))
+    chat_log.start_turn()
+    fill(chat_log, 6)
+    assert os.listdir(tmp_path)
+
+    chat_log.clear()
+    chat_log.undo_turn()
+
+    assert len(chat_log) == 0 and not os.listdir(tmp_path)
@@ -0,0 +1,102 @@
+"""
+DetectiveAI with a scripted stand-in for the model
+"""
+import os
+import random
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+from components.detective_ai import DetectiveAI
+import config
+
+
+class ScriptedModelManager:
+    """Streams a fixed reply in fixed-size chunks instead of generating one"""
+
+    tokenizer = None
+
+    def __init__(self, reply: str, chunk_size: int = 7):
+        self.reply = reply
+        self.chunk_size = chunk_size
+
+    def input_embeddings(self):
+        return None
+
+    def get_prefix_cache(self, prefix):
+        return None
+
+    def generate_response_stream(self, prompt, **kwargs):
+        for start in range(0, len(self.reply), self.chunk_size):
+            yield self.reply[start:start + self.chunk_size]
+
+
+REPLIES = [
+    "Detective Marco: The sword was moved before dinner. Someone knew the attic well. And then Partn",
+    "Marco: Detective: We should talk to the guests. All of them, one by one",
+    "  I think we need more evidence before we accuse anyone. Let's keep looking. Hm.",
+    "No full stop at all in this reply",
+    "Short.",
+    "Detective",
+    "",
+    "A long reply. " * 60,
+    "Clara was seen near the attic. " * 20 + "Then the",
+]
+
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch):
+    monkeypatch.chdir(REPO_ROOT)  # Case data paths are relative to the repo
+
+
+@pytest.mark.parametrize("reply", REPLIES, ids=[f"reply{i}" for i in range(len(REPLIES))])
+@pytest.mark.parametrize("chunk_size", [1, 3, 16])
+def test_stream_adds_up_to_recorded_reply(reply, chunk_size):
+    detective = DetectiveAI(ScriptedModelManager(reply, chunk_size))
+    detective.initialize_case("seaside_cottage")
+
+    stream, _ = detective.respond_stream("Tell me about the guests at the cottage")
+    streamed = "".join(stream)
+
+    assert streamed == detective.last_response
+    assert detective.conversation_history[-1] == f"Detective Marco: {streamed}"
+    assert len(streamed) <= config.RESPONSE_MAX_CHARS + len("...")
+
+
+def test_stream_with_discovery_adds_up_to_recorded_reply():
+    detective = DetectiveAI(ScriptedModelManager(REPLIES[0], 5))
+    detective.initialize_case("seaside_cottage")
+
+    stream, discoveries = detective.respond_stream("Who were the guests at the cottage last night?")
+    streamed = "".join(stream)
+
+    assert discoveries
+    assert streamed.startswith("🔍")
+    assert streamed == detective.last_response
+
+
+def test_settled_response_never_taken_back():
+    detective = DetectiveAI(ScriptedModelManager(""))
+    rng = random.Random(0)
+    words = ["Detective", "Marco:", "sword", "attic.", "the", "a.", "guests", " ", "\n", "...", "Clara"]
+    for _ in range(100):
+        text = "".join(rng.choice(words) + rng.choice(["", " "]) for _ in range(rng.randint(0, 60)))
+        final = detective._clean_response(text)
+        for end in range(len(text) + 1):
+            assert final.startswith(detective._settled_response(text[:end]))
+
+
+def test_case_carries_on_after_model_reload():
+    detective = DetectiveAI(ScriptedModelManager("The old model is gone now."))
+    detective.initialize_case("seaside_cottage")
+    "".join(detective.respond_stream("Who were the guests at the cottage last night?")[0])
+
+    reloaded = ScriptedModelManager("The reloaded model answers instead.")
+    detective.use_model_manager(reloaded)
+    streamed = "".join(detective.respond_stream("What about the sword?")[0])
+
+    assert detective.model_manager is reloaded
+    assert streamed == "The reloaded model answers instead."
+    assert detective.get_discovered_documents()
@@ -0,0 +1,44 @@
+"""
+Text-side generation helpers
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.generation import SentenceBudgetFilter, StopStringFilter, trim_at_sentence_budget
+
+REPLY = 'We found the sword. It was in the attic! "Who moved it?" I asked... Nobody knew.'
+
+
+@pytest.mark.parametrize("min_chars, expected", [
+    (None, REPLY),
+    (5, "We found the sword."),
+    (19, "We found the sword."),
+    (20, "We found the sword. It was in the attic!"),
+    (45, 'We found the sword. It was in the attic! "Who moved it?"'),
+    (58, 'We found the sword. It was in the attic! "Who moved it?" I asked...'),
+    (len(REPLY) + 1, REPLY),
+])
+def test_trim_at_sentence_budget(min_chars, expected):
+    assert trim_at_sentence_budget(REPLY, min_chars) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 11, len(REPLY)])
+@pytest.mark.parametrize("min_chars", [None, 5, 20, 45, 58, 200])
+def test_sentence_budget_filter_matches_trim(chunk_size, min_chars):
+    budget_filter = SentenceBudgetFilter(min_chars)
+    streamed = ""
+    for start in range(0, len(REPLY), chunk_size):
+        streamed += budget_filter.feed(REPLY[start:start + chunk_size])
+    assert streamed == trim_at_sentence_budget(REPLY, min_chars)
+
+
+def test_filters_chain():
+    stop_filter, budget_filter = StopStringFilter(["Partner:"]), SentenceBudgetFilter(30)
+    streamed = ""
+    for chunk in ["It was late. ", "Very late", " indeed. Partner:", " what?"]:
+        streamed += budget_filter.feed(stop_filter.feed(chunk))
+    streamed += budget_filter.feed(stop_filter.flush())
+    assert streamed == "It was late. Very late indeed."
@@ -0,0 +1,54 @@
+"""
+ModelRegistry memory accounting, with tiny torch modules standing in for models
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.registry import ModelRegistry
+import config
+
+
+@pytest.fixture(autouse=True)
+def no_scheduler(monkeypatch):
+    monkeypatch.setattr(config, "BATCH_SCHEDULER_ENABLED", False)
+
+
+def loader_of(n_floats: int):
+    """A loader returning a model of n_floats fp32 weights (4 bytes each)"""
+    return lambda: (torch.nn.Linear(n_floats, 1, bias=False), None)
+
+
+def test_idle_model_kept_when_both_fit():
+    registry = ModelRegistry(max_bytes=12000)
+    first = registry.acquire(("first",), loader_of(1100))
+    registry.release(first)
+
+    second = registry.acquire(("second",), loader_of(1100))
+
+    assert first.size_bytes == second.size_bytes == 4400
+    assert registry.total_bytes() == 8800
+    assert registry.acquire(("first",), loader_of(1100)) is first
+
+
+def test_idle_model_evicted_when_both_dont_fit():
+    registry = ModelRegistry(max_bytes=8000)
+    first = registry.acquire(("first",), loader_of(1100))
+    registry.release(first)
+
+    registry.acquire(("second",), loader_of(1100))
+
+    assert registry.total_bytes() == 4400
+    assert list(registry._entries) == [("second",)]
+
+
+def test_models_in_use_over_limit_raise():
+    registry = ModelRegistry(max_bytes=8000)
+    registry.acquire(("first",), loader_of(1100))
+
+    with pytest.raises(MemoryError):
+        registry.acquire(("second",), loader_of(1100))
+    assert registry.total_bytes() == 4400
@@ -0,0 +1,71 @@
+"""
+GenerationScheduler bookkeeping that doesn't need a model
+"""
+import os
+import sys
+import threading
+
+import pytest
+import torch
+from transformers import StoppingCriteria
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.scheduler import GenerationRequest, GenerationScheduler, _BatchStreamer, _RowStopCriteria
+
+
+class RecordingStreamer:
+    def __init__(self):
+        self.tokens = []
+        self.ended = 0
+
+    def put(self, value):
+        self.tokens.extend(value.tolist())
+
+    def end(self):
+        self.ended += 1
+
+
+class StopRows(StoppingCriteria):
+    """Stops the given rows, whatever was generated"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor([row in self.rows for row in range(input_ids.shape[0])])
+
+
+def test_stopped_row_stream_ends_before_batch():
+    streamers = [RecordingStreamer(), None, RecordingStreamer()]
+    batch_streamer = _BatchStreamer(streamers)
+    criteria = _RowStopCriteria([StopRows({0})], eos_token_id=None, streamer=batch_streamer)
+
+    batch_streamer.put(torch.tensor([5, 6, 7]))
+    assert criteria(torch.zeros(3, 4, dtype=torch.long), None).tolist() == [True, False, False]
+    assert (streamers[0].ended, streamers[2].ended) == (1, 0)
+
+    # Finished rows get padding from then on - none of it reaches their stream
+    batch_streamer.put(torch.tensor([0, 8, 9]))
+    batch_streamer.end()
+    assert streamers[0].tokens == [5] and streamers[2].tokens == [7, 9]
+    assert (streamers[0].ended, streamers[2].ended) == (1, 1)
+
+
+def test_eos_row_stream_ends():
+    streamers = [RecordingStreamer(), RecordingStreamer()]
+    criteria = _RowStopCriteria([], eos_token_id=2, streamer=_BatchStreamer(streamers))
+
+    assert criteria(torch.tensor([[1, 2], [1, 3]]), None).tolist() == [True, False]
+    assert [streamer.ended for streamer in streamers] == [1, 0]
+
+
+def test_submit_after_shutdown_fails_right_away():
+    scheduler = GenerationScheduler(None, None, threading.Lock())
+    scheduler.shutdown()
+    streamer = RecordingStreamer()
+
+    request = scheduler.submit(GenerationRequest(torch.tensor([1, 2]), 4, 0.7, streamer=streamer))
+
+    with pytest.raises(RuntimeError):
+        request.future.result(timeout=0)
+    assert streamer.ended == 1
@@ -0,0 +1,211 @@
+"""
+Prebuilt, memory-mapped retrieval index covering every document of a case
+
+A case's text is fixed, so its document vectors and keyword postings are built
+once (on first use, or ahead of time with `python -m utils.case_index <case>`)
+and every session maps the same files read-only. A session only owns a
+bitset of the documents it has discovered.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+VECTORS_FILE = "vectors.npy"
+TOKEN_COLUMNS_FILE = "token_columns.npy"
+KEYWORDS_FILE = "keywords.json"
+
+
+def bm25_idf(num_docs: int, document_frequency: int) -> float:
+    """BM25's (always positive) inverse document frequency"""
+    return math.log(1 + (num_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+class CaseIndex:
+    """Read-only document vectors and BM25 postings for one case, shared by all its sessions"""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            meta = json.load(f)
+        self.path = path
+        self.doc_ids = meta["doc_ids"]
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+        self.retrieval_mode = meta["retrieval_mode"]
+
+        # Memory-mapped: pages come from the OS page cache, shared by every process
+        self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        token_columns_path = os.path.join(path, TOKEN_COLUMNS_FILE)
+        self.token_columns = np.load(token_columns_path, mmap_mode="r") if os.path.exists(token_columns_path) else None
+
+        with open(os.path.join(path, KEYWORDS_FILE)) as f:
+            keywords = json.load(f)
+        self.doc_lengths = np.asarray(keywords["doc_lengths"], dtype=np.float64)
+        self.postings = {
+            term: (np.asarray(rows, dtype=np.int64), np.asarray(frequencies, dtype=np.float64))
+            for term, (rows, frequencies) in keywords["postings"].items()
+        }
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id: str):
+        return doc_id in self.rows
+
+    def search(self, query_vector: np.ndarray, mask: np.ndarray, top_k: int,
+               min_score: float) -> List[Tuple[str, float]]:
+        """
+        Best matching discovered documents by cosine similarity
+
+        Args:
+            query_vector: Normalized query in the index's column space
+            mask: Which documents this session has discovered
+            top_k: Most results to return
+            min_score: Similarity a document has to beat
+
+        Returns:
+            (doc id, score) pairs, best first
+        """
+        if not mask.any():
+            return []
+        scores = self.vectors @ query_vector
+        scores[~mask] = -np.inf
+        return self._top(scores, top_k, min_score)
+
+    def bm25_statistics(self, terms: Set[str], mask: np.ndarray) -> Tuple[int, int, Dict[str, int]]:
+        """(document count, total length, document frequency of each term) over the discovered documents"""
+        document_frequencies = {
+            term: int(mask[self.postings[term][0]].sum()) if term in self.postings else 0
+            for term in terms
+        }
+        return int(mask.sum()), int(self.doc_lengths[mask].sum()), document_frequencies
+
+    def bm25_search(self, terms: List[str], mask: np.ndarray, top_k: int, k1: float, b: float,
+                    statistics: Tuple[int, int, Dict[str, int]] = None) -> List[Tuple[str, float]]:
+        """
+        BM25 over the discovered documents only
+
+        Args:
+            terms: Query terms, tokenized like the indexed text
+            mask: Which documents this session has discovered
+            top_k: Most results to return
+            k1, b: BM25 parameters
+            statistics: Collection statistics to weight terms by - defaults to
+                those of the discovered documents
+
+        Returns:
+            (doc id, score) pairs, best first
+        """
+        num_docs, total_length, document_frequencies = statistics or self.bm25_statistics(set(terms), mask)
+        if num_docs == 0 or not mask.any():
+            return []
+        average_length = total_length / num_docs
+
+        scores = np.zeros(len(self.doc_ids))
+        for term in set(terms):
+            if term not in self.postings:
+                continue
+            rows, frequencies = self.postings[term]
+            discovered = mask[rows]
+            if not discovered.any():
+                continue
+            rows, frequencies = rows[discovered], frequencies[discovered]
+            idf = bm25_idf(num_docs, document_frequencies[term])
+            length_norm = k1 * (1 - b + b * self.doc_lengths[rows] / average_length)
+            scores[rows] += idf * frequencies * (k1 + 1) / (frequencies + length_norm)
+        return self._top(scores, top_k, 0.0)
+
+    def _top(self, scores: np.ndarray, top_k: int, min_score: float) -> List[Tuple[str, float]]:
+        """(doc id, score) for the `top_k` highest scores above min_score"""
+        top_k = min(top_k, len(scores))
+        if top_k <= 0:
+            return []
+        rows = np.argpartition(-scores, top_k - 1)[:top_k]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+        return [(self.doc_ids[row], float(scores[row])) for row in rows if scores[row] > min_score]
+
+
+def write_case_index(path: str, doc_ids: List[str], retrieval_mode: str, vectors: np.ndarray,
+                     token_columns: np.ndarray, postings: Dict[str, Dict[str, int]], doc_lengths: Dict[str, int]):
+    """
+    Save a case index to `path`
+
+    Written to a directory private to this call and renamed into place, so
+    sessions building the same index at once - threads of one process
+    included - never see or disturb a partial one.
+    """
+    rows = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial_path = tempfile.mkdtemp(prefix=f"{os.path.basename(path)}.", suffix=".partial", dir=os.path.dirname(path))
+
+    try:
+        np.save(os.path.join(partial_path, VECTORS_FILE), np.ascontiguousarray(vectors, dtype=np.float32))
+        if token_columns is not None:
+            np.save(os.path.join(partial_path, TOKEN_COLUMNS_FILE), token_columns)
+        with open(os.path.join(partial_path, KEYWORDS_FILE), "w") as f:
+            json.dump({
+                "doc_lengths": [doc_lengths[doc_id] for doc_id in doc_ids],
+                "postings": {
+                    term: [[rows[doc_id] for doc_id in docs], list(docs.values())]
+                    for term, docs in postings.items()
+                }
+            }, f)
+        with open(os.path.join(partial_path, INDEX_FILE), "w") as f:
+            json.dump({"doc_ids": doc_ids, "retrieval_mode": retrieval_mode}, f)
+    except BaseException:
+        shutil.rmtree(partial_path, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(partial_path, path)
+    except OSError:
+        # Someone else finished the same index first - theirs is identical
+        shutil.rmtree(partial_path, ignore_errors=True)
+
+
+_loaded_indexes = {}
+_loaded_indexes_lock = threading.Lock()
+
+
+def load_case_index(path: str) -> CaseIndex:
+    """The index at `path`, mapped once per process and shared by every session"""
+    with _loaded_indexes_lock:
+        index = _loaded_indexes.get(path)
+        if index is None:
+            index = CaseIndex(path)
+            _loaded_indexes[path] = index
+        return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the prebuilt retrieval index for one or more cases")
+    parser.add_argument("cases", nargs="+", help="Case names, e.g. seaside_cottage")
+    parser.add_argument("--with-model", action="store_true",
+                        help="Load the game's model too - needed when RAG_RETRIEVAL_MODE is 'dense'")
+    args = parser.parse_args()
+
+    from data.case_manager import CaseDocumentManager
+
+    input_embeddings, tokenizer = None, None
+    if args.with_model:
+        from models.model_manager import ModelManager
+        model_manager = ModelManager().load_model(use_lora=True)
+        input_embeddings, tokenizer = model_manager.input_embeddings(), model_manager.tokenizer
+
+    for case_name in args.cases:
+        # Setting up a case builds its index if it isn't on disk yet
+        rag_system = CaseDocumentManager(case_name, input_embeddings, tokenizer).rag_system
+        if rag_system.case_index is None:
+            print(f"No index built for {case_name}")
+        else:
+            print(f"{case_name}: {len(rag_system.case_index)} documents indexed in {rag_system.case_index.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Bounded chat history for the Streamlit app
+
+Messages are kept compactly - role, text and the ids of the documents
+discovered with them, never the Document objects - and only the latest ones
+stay in memory. Older messages are appended to a per-session spill file and
+read back only when the player asks to see them.
+"""
+import json
+import os
+import tempfile
+import weakref
+from array import array
+from collections import deque
+from typing import List, Tuple
+
+import config
+
+Message = Tuple[str, str, Tuple[str, ...]]  # (role, content, discovered document ids)
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ChatLog:
+    """Chat messages with a fixed number held in memory and the rest spilled to disk"""
+
+    def __init__(self, max_in_memory: int = None, spill_dir: str = None):
+        """
+        Args:
+            max_in_memory: Latest messages kept in memory - defaults to config.CHAT_HISTORY_LIMIT
+            spill_dir: Where older messages go - defaults to config.CHAT_SPILL_DIR, else the system temp dir
+        """
+        self.max_in_memory = max(max_in_memory or config.CHAT_HISTORY_LIMIT, 1)
+        # Outside the repo - if the process is killed, the OS cleans the file up, not git status
+        self.spill_dir = spill_dir or config.CHAT_SPILL_DIR or tempfile.gettempdir()
+        self._recent = deque()  # The newest messages
+        self._spill_path = None  # Created on the first spill
+        self._spill_offsets = array("q")  # Start of each spilled message in the file, 8 bytes each
+        self._spill_end = 0  # Bytes of the file in use
+        self._finalizer = None
+        # Length of the log when each recent turn began - kept in step with DetectiveAI's undo snapshots
+        self._turn_starts = deque(maxlen=config.UNDO_LIMIT)
+
+    def __len__(self):
+        return len(self._spill_offsets) + len(self._recent)
+
+    def append(self, role: str, content: str, discovered_ids: Tuple[str, ...] = ()):
+        """Add a message, spilling the oldest in-memory one to disk when over the limit"""
+        self._recent.append((role, content, tuple(discovered_ids)))
+        while len(self._recent) > self.max_in_memory:
+            self._spill(self._recent.popleft())
+
+    def latest(self, count: int) -> List[Message]:
+        """
+        The last `count` messages, oldest first
+
+        Only reads the spill file when `count` reaches past the in-memory ones
+        (e.g. after "Load earlier").
+        """
+        count = min(count, len(self))
+        from_disk = count - len(self._recent)
+        messages = self._read_spilled(len(self._spill_offsets) - from_disk) if from_disk > 0 else []
+        recent = list(self._recent)
+        return messages + recent[len(recent) - (count - len(messages)):]
+
+    def pop(self, count: int = 1):
+        """Drop the last `count` messages (e.g. to undo a question), pulling spilled ones back if needed"""
+        for _ in range(min(count, len(self))):
+            if not self._recent:
+                self._recent.extend(self._read_spilled(len(self._spill_offsets) - 1))
+                self._truncate_spill(len(self._spill_offsets) - 1)
+            self._recent.pop()
+
+    def start_turn(self):
+        """Mark where a turn begins, just before its question is asked (and DetectiveAI takes its undo snapshot)"""
+        self._turn_starts.append(len(self))
+
+    def undo_turn(self):
+        """
+        Drop every message of the last turn, however many it got to write
+
+        A turn whose reply was interrupted (e.g. by a rerun mid-stream) only
+        wrote the question, so popping a fixed count would drop the wrong messages.
+        """
+        if self._turn_starts:
+            self.pop(len(self) - self._turn_starts.pop())
+
+    def clear(self):
+        """Forget every message and delete the spill file"""
+        self._recent.clear()
+        self._turn_starts.clear()
+        if self._finalizer is not None:
+            self._finalizer()  # Removes the file
+        self._spill_path = None
+        self._finalizer = None
+        self._spill_offsets = array("q")
+        self._spill_end = 0
+
+    def _spill(self, message: Message):
+        """Append one message to the spill file"""
+        if self._spill_path is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, self._spill_path = tempfile.mkstemp(prefix="chat_", suffix=".jsonl", dir=self.spill_dir)
+            os.close(fd)
+            # The file only lives as long as the session's ChatLog
+            self._finalizer = weakref.finalize(self, _remove_file, self._spill_path)
+
+        line = (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self._spill_path, "r+b") as f:
+            f.seek(self._spill_end)
+            f.write(line)
+        self._spill_offsets.append(self._spill_end)
+        self._spill_end += len(line)
+
+    def _read_spilled(self, start: int) -> List[Message]:
+        """Spilled messages from index `start` to the last one"""
+        if start >= len(self._spill_offsets):
+            return []
+        with open(self._spill_path, "rb") as f:
+            f.seek(self._spill_offsets[start])
+            data = f.read(self._spill_end - self._spill_offsets[start])
+        return [
+            (role, content, tuple(discovered_ids))
+            for role, content, discovered_ids in (json.loads(line) for line in data.splitlines())
+        ]
+
+    def _truncate_spill(self, start: int):
+        """Forget spilled messages from index `start` on - later spills overwrite them"""
+        self._spill_end = self._spill_offsets[start]
+        del self._spill_offsets[start:]
@@ -1,14 +1,29 @@
 """
 Document discovery and RAG system for the detective game
 """
+import hashlib
+import heapq
+import itertools
 import json
+import math
+import os
 import re
+import tempfile
+from collections import Counter, OrderedDict
 from typing import List, Dict, Set, Tuple
 from dataclasses import dataclass
 import numpy as np
 import torch
 import torch.nn.functional as F
-from transformers import AutoTokenizer
+
+import config
+from utils.case_index import bm25_idf, load_case_index, write_case_index
+from utils.helpers import ViewCache
+from utils.keyword_matcher import KeywordAutomaton, KeywordScanner
+from utils.log import get_logger
+from utils.tokenizer_cache import get_tokenizer, vocab_size
+
+logger = get_logger("discovery")
 
 try:
     # import issues :(
@@ -21,38 +36,156 @@ except ImportError:
     print("Warning: sentence-transformers not available, using keyword-based retrieval")
 
 
-@dataclass
 class Document:
-    """Represents a clue/document in the case"""
-    id: str
-    title: str
-    content: str
-    keywords: List[str]  # Keywords that trigger discovery
-    category: str  # e.g., "witness_statement", "physical_evidence", "records"
-    importance: int  # 1-5, how crucial this clue is
-    discovered: bool = False
-    discovery_message: str = ""  # Message shown when discovered
+    """
+    Represents a clue/document in the case
+
+    Immutable, so one object per document is shared by every session playing
+    the case - whether it has been discovered is tracked per session by
+    DocumentDiscoverySystem.
+    """
+    __slots__ = ("id", "title", "content", "keywords", "category", "importance", "discovery_message")
+
+    def __init__(self, id: str, title: str, content: str, keywords: List[str], category: str, importance: int,
+                 discovery_message: str = ""):
+        """
+        Args:
+            id: Unique within the case
+            title: Shown to the player
+            content: The document text
+            keywords: Keywords that trigger discovery
+            category: e.g., "witness_statement", "physical_evidence", "records"
+            importance: 1-5, how crucial this clue is
+            discovery_message: Message shown when discovered
+        """
+        for name, value in (("id", id), ("title", title), ("content", content), ("keywords", tuple(keywords)),
+                            ("category", category), ("importance", importance),
+                            ("discovery_message", discovery_message)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Document is immutable, can't set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Document is immutable, can't delete {name}")
+
+    def _fields(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Document) and self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return f"Document(id={self.id!r}, title={self.title!r}, category={self.category!r})"
+
+
+@dataclass
+class SparseEmbedding:
+    """L2-normalized bag-of-tokens vector stored as its non-zero entries only"""
+    token_ids: torch.Tensor  # Sorted, unique token ids
+    weights: torch.Tensor  # Weight of each token id
+
+
+class LRUCache:
+    """Size-bounded mapping that forgets the least recently used entry first, counting hits and misses"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries  # 0 disables caching
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The cached value for key, or None"""
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0 or value is None:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_state_versions = itertools.count(1)  # Shared by every DocumentDiscoverySystem, so versions never collide
 
 
 class DocumentDiscoverySystem:
     """Manages document discovery through keyword matching"""
 
-    def __init__(self):
+    def __init__(self, case=None):
+        """
+        Args:
+            case: A shared data.case_catalog.CaseData to start from - its documents,
+                keyword map and automaton are used as they are, not rebuilt
+        """
         self.documents = {}
-        self.discovered_docs = set()
         self.keyword_map = {}  # Maps keywords to document IDs
+        self._keyword_automaton = None  # Compiled from keyword_map on first use
+        self._positions = {}  # Document id -> its bit in _discovered_bits
+        self._shares_case = False  # documents/keyword_map/_positions belong to the case catalog - copy before changing
+        if case is not None:
+            self.documents = case.documents_by_id
+            self.keyword_map = case.keyword_map
+            self._keyword_automaton = case.keyword_automaton
+            self._positions = case.positions
+            self._shares_case = True
+
+        # All of a session's own state: one bit per document plus the order they were found in.
+        # Both are immutable values, so a snapshot is just a reference to them
+        self._discovered_bits = 0
+        self.discovery_order = ()  # Discovered document ids, first discovery first
+
+        # Changes (to a number never used before, by any session) whenever anything above does -
+        # views derived from this state are memoized against it
+        self.version = next(_state_versions)
+        self._views = ViewCache()
+
         self.solution = "Clara surprised Hugo in the attic"  # The correct solution
         self.solution_keywords = ["clara", "hugo", "attic", "surprised", "caught", "found"]  # Keywords that might indicate solution discovery
 
     def add_document(self, document: Document):
         """Add a document to the system"""
+        if self._shares_case:
+            self.documents = dict(self.documents)
+            self.keyword_map = {keyword: list(doc_ids) for keyword, doc_ids in self.keyword_map.items()}
+            self._positions = dict(self._positions)
+            self._shares_case = False
         self.documents[document.id] = document
+        self._positions.setdefault(document.id, len(self._positions))
+        self.version = next(_state_versions)
 
         # Map keywords to this document
         for keyword in document.keywords:
             if keyword.lower() not in self.keyword_map:
                 self.keyword_map[keyword.lower()] = []
             self.keyword_map[keyword.lower()].append(document.id)
+        self._keyword_automaton = None
+
+    def _get_keyword_automaton(self) -> KeywordAutomaton:
+        """Every keyword compiled into one automaton, rebuilt only after documents are added"""
+        if self._keyword_automaton is None:
+            self._keyword_automaton = KeywordAutomaton(list(self.keyword_map), whole_words=config.DISCOVERY_WHOLE_WORDS)
+        return self._keyword_automaton
 
     def check_for_discoveries(self, text: str) -> List[Document]:
         """Check if any keywords in the text trigger document discoveries"""
@@ -71,22 +204,87 @@ class DocumentDiscoverySystem:
                 discovery_message="You've solved the case! 🎉"
             )
             newly_discovered.append(solution_doc)
-            print(f"Solution discovered! Total discovered docs: {len(self.discovered_docs) + 1}")
+            logger.debug("Solution discovered! Total discovered docs: %d", len(self.discovery_order) + 1)
             return newly_discovered
 
-        # Regular document discovery
-        for keyword, doc_ids in self.keyword_map.items():
-            if keyword in text_lower:
-                for doc_id in doc_ids:
-                    if doc_id not in self.discovered_docs:
-                        doc = self.documents[doc_id]
-                        doc.discovered = True
-                        self.discovered_docs.add(doc_id)
-                        newly_discovered.append(doc)
-                        print(f"Document {doc_id} discovered! Total discovered docs: {len(self.discovered_docs)}")
+        # Regular document discovery - one pass over the text finds every keyword
+        automaton = self._get_keyword_automaton()
+        return self._discover_keywords(automaton, automaton.find(text_lower))
+
+    def keyword_scanner(self) -> KeywordScanner:
+        """Start a resumable keyword scan, for text that arrives in pieces (e.g. Marco's streamed reply)"""
+        return self._get_keyword_automaton().scanner()
+
+    def check_chunk_for_discoveries(self, scanner: KeywordScanner, chunk: str) -> List[Document]:
+        """
+        Continue a keyword scan with the next piece of text
+
+        Only keyword clues are discovered - the model naming the culprit
+        doesn't solve the case for the player.
+
+        Args:
+            scanner: From keyword_scanner(), carries the match state between chunks
+            chunk: The next piece of text
+
+        Returns:
+            Documents discovered by this chunk
+        """
+        return self._discover_keywords(scanner.automaton, scanner.feed(chunk.lower()))
+
+    def finish_scan(self, scanner: KeywordScanner) -> List[Document]:
+        """End a keyword scan - a whole-word keyword at the very end of the text only counts now"""
+        return self._discover_keywords(scanner.automaton, scanner.finish())
+
+    def _discover_keywords(self, automaton: KeywordAutomaton, keyword_indices) -> List[Document]:
+        """Mark the documents of the matched keywords discovered, returning the ones that are new"""
+        newly_discovered = []
+        # Indices follow keyword_map order, so documents are discovered in keyword_map order
+        for keyword_index in sorted(keyword_indices):
+            for doc_id in self.keyword_map[automaton.keywords[keyword_index]]:
+                if self._mark_discovered(doc_id):
+                    newly_discovered.append(self.documents[doc_id])
+                    logger.debug("Document %s discovered! Total discovered docs: %d", doc_id, len(self.discovery_order))
 
         return newly_discovered
 
+    def _mark_discovered(self, doc_id: str) -> bool:
+        """Set a document's bit, returning whether it was newly discovered"""
+        bit = 1 << self._positions[doc_id]
+        if self._discovered_bits & bit:
+            return False
+        self._discovered_bits |= bit
+        self.discovery_order += (doc_id,)
+        self.version = next(_state_versions)
+        return True
+
+    def mark_discovered(self, document: Document) -> bool:
+        """Discover a document directly (e.g. the solution), adding it first if it isn't part of the case"""
+        if document.id not in self.documents:
+            self.add_document(document)
+        return self._mark_discovered(document.id)
+
+    def is_discovered(self, doc_id: str) -> bool:
+        position = self._positions.get(doc_id)
+        return position is not None and bool(self._discovered_bits >> position & 1)
+
+    @property
+    def discovered_docs(self) -> frozenset:
+        """Ids of the discovered documents"""
+        return frozenset(self.discovery_order)
+
+    def snapshot(self) -> Tuple[int, Tuple[str, ...]]:
+        """The discovery state, to hand back to restore() later - constant time"""
+        return self._discovered_bits, self.discovery_order
+
+    def restore(self, snapshot: Tuple[int, Tuple[str, ...]]):
+        """Go back to a state from snapshot() - constant time"""
+        self._discovered_bits, self.discovery_order = snapshot
+        self.version = next(_state_versions)
+
+    def reset(self):
+        """Forget every discovery - the documents themselves are untouched"""
+        self.restore((0, ()))
+
     def _is_solution_discovered(self, text: str) -> bool:
         """Check if the text contains the solution"""
         # Check if all key elements of the solution are present
@@ -100,10 +298,13 @@ class DocumentDiscoverySystem:
         normalized_solution = " ".join(self.solution.lower().split())
         return normalized_proposed == normalized_solution
 
-    def get_discovered_documents(self) -> List[Document]:
-        """Get all discovered documents"""
-        discovered = [self.documents[doc_id] for doc_id in self.discovered_docs]
-        print(f"Retrieving discovered documents. Total count: {len(discovered)}")
+    def get_discovered_documents(self) -> Tuple[Document, ...]:
+        """Get all discovered documents, in the order they were discovered - rebuilt only after a change"""
+        return self._views.get("discovered", self.version, self._build_discovered_documents)
+
+    def _build_discovered_documents(self) -> Tuple[Document, ...]:
+        discovered = tuple(self.documents[doc_id] for doc_id in self.discovery_order)
+        logger.debug("Retrieving discovered documents. Total count: %d", len(discovered))
         return discovered
 
     def get_document_by_id(self, doc_id: str) -> Document:
@@ -111,134 +312,685 @@ class DocumentDiscoverySystem:
         return self.documents.get(doc_id)
 
 
+@dataclass(frozen=True)
+class Passage:
+    """A piece of a document small enough to be packed into the prompt on its own"""
+    doc_id: str
+    index: int  # Position within the document
+    text: str
+    token_count: int
+    terms: frozenset  # Its BM25Index.tokenize words, to match against the query
+
+
+class BM25Index:
+    """
+    Inverted index with Okapi BM25 scoring
+
+    Postings are updated as documents are added, and a query only touches the
+    postings of its own terms - never the rest of the corpus.
+    """
+
+    WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # Term -> {doc id: term frequency}
+        self.doc_lengths = {}  # Doc id -> number of terms
+        self.doc_terms = {}  # Doc id -> distinct terms, so removal only visits its own postings
+        self.total_length = 0
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls.WORD_PATTERN.findall(text.lower())
+
+    def add(self, doc_id: str, text: str):
+        """Index a document, replacing any earlier version with the same id"""
+        if doc_id in self.doc_lengths:
+            self.remove(doc_id)
+
+        terms = self.tokenize(text)
+        counts = Counter(terms)
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        self.doc_terms[doc_id] = list(counts)
+        self.doc_lengths[doc_id] = len(terms)
+        self.total_length += len(terms)
+
+    def remove(self, doc_id: str):
+        """Drop a document from the index"""
+        self.total_length -= self.doc_lengths.pop(doc_id)
+        for term in self.doc_terms.pop(doc_id):
+            postings = self.postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+
+    def statistics(self, terms: Set[str]) -> Tuple[int, int, Dict[str, int]]:
+        """(document count, total length, document frequency of each term) - what BM25 weights by"""
+        return len(self.doc_lengths), self.total_length, {term: len(self.postings.get(term, ())) for term in terms}
+
+    def search(self, query: str, top_k: int, statistics: Tuple[int, int, Dict[str, int]] = None) -> List[Tuple[str, float]]:
+        """
+        Best `top_k` (doc id, score) pairs - only documents sharing a term with the query score
+
+        Args:
+            query: Text to search for
+            top_k: Most results to return
+            statistics: Collection statistics to weight terms by, when this index
+                only holds part of the collection - defaults to its own
+        """
+        terms = set(self.tokenize(query))
+        num_docs, total_length, document_frequencies = statistics or self.statistics(terms)
+        if num_docs == 0:
+            return []
+        average_length = total_length / num_docs
+
+        scores = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = bm25_idf(num_docs, document_frequencies[term])
+            for doc_id, frequency in postings.items():
+                length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + length_norm)
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+# Passages depend only on the document text and tokenizer, so every session shares them
+_passage_cache = {}  # (tokenizer, passage size, doc id, text hash) -> (header, header tokens, passages)
+_case_passages = {}  # (tokenizer, passage size, case fingerprint) -> passages of each document, in order
+
+
+DENSE_POOLING = "centered-mean-v1"  # Bump when the pooling changes, so cached vectors are recomputed
+
+
+def _embedding_fingerprint(weights: torch.Tensor) -> str:
+    """Cheap identity for an embedding table - its shape plus a strided sample of rows"""
+    sample = weights[::max(1, weights.shape[0] // 64)].detach().float().cpu()
+    digest = hashlib.sha256(f"{DENSE_POOLING}:{tuple(weights.shape)}".encode())
+    digest.update(sample.numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
 class RAGSystem:
     """Retrieval-Augmented Generation system for using discovered documents"""
 
-    def __init__(self, model_name='TinyLlama/TinyLlama-1.1B-Chat-v1.0'):
-        """Initialize the RAG system with TinyLLaMA tokenizer"""
-        self.tokenizer = None
-        try:
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            print("Successfully loaded TinyLLaMA tokenizer for RAG")
-        except Exception as e:
-            print(f"Could not load TinyLLaMA tokenizer: {e}")
-            self.tokenizer = None
-
+    MIN_SIMILARITY = 0.1  # Minimum similarity threshold for semantic retrieval
+
+    def __init__(self, model_name='TinyLlama/TinyLlama-1.1B-Chat-v1.0', input_embeddings: torch.Tensor = None,
+                 retrieval_mode: str = None, tokenizer=None):
+        """
+        Initialize the RAG system with TinyLLaMA tokenizer
+
+        Args:
+            model_name: Tokenizer to use when none is passed in
+            input_embeddings: The loaded model's token embedding table, needed for dense retrieval
+            retrieval_mode: "tokens" (token overlap), "dense" (pooled input embeddings) or
+                "bm25" (keyword index) - defaults to config.RAG_RETRIEVAL_MODE
+            tokenizer: An already loaded tokenizer to share, e.g. the ModelManager's
+        """
+        self.tokenizer = tokenizer
+        if self.tokenizer is None:
+            try:
+                self.tokenizer = get_tokenizer(model_name)
+                print("Successfully loaded TinyLLaMA tokenizer for RAG")
+            except Exception as e:
+                print(f"Could not load TinyLLaMA tokenizer: {e}")
+                self.tokenizer = None
+        self.vocab_size = vocab_size(self.tokenizer) if self.tokenizer is not None else 0
+
+        # Documents added outside the case index (e.g. the solution) - case documents aren't copied here
+        self._added = ()  # Every such document in the order added, to rebuild this state on restore()
         self.document_embeddings = {}
         self.documents = {}
+        self.passages = {}  # Document id -> (header, header tokens, passages)
+        self.keyword_index = BM25Index()  # Always kept, it is also the fallback without a tokenizer
+
+        # Retrieval index: one row per document, one column per token id seen in any
+        # document. Rows are pre-normalized, so scoring a query is a single matmul.
+        self._doc_matrix = torch.zeros(0, 0)  # Over-allocated, grown by doubling
+        self._matrix_doc_ids = []  # Row -> document id
+        self._doc_rows = {}  # Document id -> row
+        self._num_columns = 0
+        # Token id -> column, -1 if unseen. Vocab-sized, so only allocated once a document needs it -
+        # with a case index most sessions never do
+        self._token_columns = None
+
+        # Prebuilt index shared by every session of the case - this session only owns a bitset of
+        # its discovered rows (an int, so snapshots share it), unpacked into a mask when searching
+        self.case_index = None
+        self._discovered_bits = 0
+        self._mask = None
+        self._mask_bits = None  # The bits _mask was unpacked from
+        self._case_documents = ()  # Index row -> document, shared with the case catalog
+        self._case_passages = ()  # Index row -> (header, header tokens, passages), shared between sessions
+
+        # Players repeat the suggested questions a lot: query embeddings are kept per
+        # query text, finished contexts per (query, discovered documents version)
+        self.discovery_version = 0  # Names the current set of documents; 0 is none
+        self._versions = itertools.count(1)  # Never reused, even after restore() goes back to an old version
+        self._query_cache = LRUCache(config.RAG_QUERY_CACHE_SIZE)
+        self._context_cache = LRUCache(config.RAG_CONTEXT_CACHE_SIZE)
+
+        self.retrieval_mode = retrieval_mode or config.RAG_RETRIEVAL_MODE
+        self.input_embeddings = None
+        if self.retrieval_mode == "dense":
+            if input_embeddings is not None and self.tokenizer is not None:
+                self._use_input_embeddings(input_embeddings)
+            else:
+                print("Dense retrieval needs the loaded model and tokenizer - falling back to token overlap")
+                self.retrieval_mode = "tokens"
+
+    def _use_input_embeddings(self, weights: torch.Tensor):
+        """Set up dense retrieval over the model's own embedding table - no second model is loaded"""
+        self.input_embeddings = weights.detach()
+        # Raw input embeddings all share a large common direction; without removing
+        # it every pair of texts looks similar
+        self._embedding_center = self.input_embeddings.mean(dim=0, dtype=torch.float).cpu()
+        self._special_ids = torch.tensor(self.tokenizer.all_special_ids, dtype=torch.long)
+        self._embedding_cache_dir = os.path.join(config.RAG_EMBEDDING_CACHE_DIR, _embedding_fingerprint(weights))
+        # Matrix columns are the embedding dimensions instead of token ids
+        self._num_columns = self.input_embeddings.shape[1]
+
+    def use_case_index(self, case_name: str, documents: List[Document], fingerprint: str = None):
+        """
+        Serve a case's documents from its prebuilt index, building the index on first use
+
+        Discovering one of these documents later just marks it in this session's
+        mask. Anything else added (e.g. the solution) is embedded as usual.
+
+        Args:
+            case_name: Case the documents belong to
+            documents: Every document of the case, discovered or not
+            fingerprint: Precomputed hash of the documents (CaseData.fingerprint), saves hashing them again
+        """
+        if self.tokenizer is None or not documents:
+            return
+
+        path = os.path.join(config.CASE_INDEX_DIR, case_name, self._case_index_key(documents, fingerprint))
+        if not os.path.isdir(path):
+            self._build_case_index(path, documents)
+        self.case_index = load_case_index(path)
+        self._discovered_bits = 0
+        # The index key covers the documents in order, so its rows line up with them
+        self._case_documents = tuple(documents)
+        self._case_passages = self._get_case_passages(documents, fingerprint)
+
+    def _case_index_key(self, documents: List[Document], fingerprint: str = None) -> str:
+        """Changes whenever the case text, tokenizer, model embeddings or retrieval mode do"""
+        digest = hashlib.sha256(f"{self.retrieval_mode}:{self.tokenizer.name_or_path}:{self.vocab_size}".encode())
+        if self.retrieval_mode == "dense":
+            digest.update(self._embedding_cache_dir.encode())  # Ends in the embedding table's fingerprint
+        if fingerprint is not None:
+            digest.update(f"\0{fingerprint}".encode())
+        else:
+            for doc in documents:
+                digest.update(f"\0{doc.id}\0{doc.title}\0{doc.content}".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def _build_case_index(self, path: str, documents: List[Document]):
+        """Embed every document of a case and write the shared index"""
+        doc_texts = [f"{doc.title} {doc.content}" for doc in documents]
+        keywords = BM25Index()
+        for doc, doc_text in zip(documents, doc_texts):
+            keywords.add(doc.id, doc_text)
+
+        token_columns = None
+        if self.retrieval_mode == "dense":
+            vectors = np.zeros((len(documents), self._num_columns), dtype=np.float32)
+            for row, doc_text in enumerate(doc_texts):
+                embedding = self._get_dense_embedding(doc_text)
+                if embedding is not None:
+                    vectors[row] = embedding.numpy()
+        else:
+            # Same layout as the incremental matrix: one column per token id any document contains
+            embeddings = [self._get_embedding(doc_text) for doc_text in doc_texts]
+            token_ids = torch.unique(torch.cat([embedding.token_ids for embedding in embeddings])).numpy()
+            token_columns = np.full(self.vocab_size, -1, dtype=np.int64)
+            token_columns[token_ids] = np.arange(len(token_ids))
+            vectors = np.zeros((len(documents), len(token_ids)), dtype=np.float32)
+            for row, embedding in enumerate(embeddings):
+                vectors[row, token_columns[embedding.token_ids.numpy()]] = embedding.weights.numpy()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_case_index(path, [doc.id for doc in documents], self.retrieval_mode, vectors, token_columns,
+                         keywords.postings, keywords.doc_lengths)
+        print(f"Built retrieval index for {len(documents)} documents in {path}")
+
+    def _encode(self, text: str, max_length: int = 512) -> torch.Tensor:
+        """Token ids of text, cut to max_length"""
+        # No truncation/padding arguments - they reconfigure the fast tokenizer, which is shared with generation
+        return torch.tensor(self.tokenizer.encode(text)[:max_length], dtype=torch.long)
+
+    def _get_embedding(self, text: str) -> SparseEmbedding:
+        """Get a normalized token-presence embedding for text using TinyLLaMA tokenizer"""
+        if self.tokenizer is None:
+            return None
 
-    def _get_embedding(self, text: str) -> torch.Tensor:
-        """Get embedding for text using TinyLLaMA tokenizer"""
-        if not self.tokenizer:
+        input_ids = self._encode(text)
+
+        # One-hot token presence, kept sparse: only the ids that occur are stored
+        # instead of a vocab-sized tensor (32k floats) per document and query.
+        # This is a basic approach - retrieval_mode="dense" uses the model's embeddings instead
+        token_ids = torch.unique(input_ids)  # Sorted
+        token_ids = token_ids[(token_ids >= 0) & (token_ids < self.vocab_size)]
+        weights = torch.ones(len(token_ids), dtype=torch.float)
+        weights = F.normalize(weights, p=2, dim=0)
+        return SparseEmbedding(token_ids, weights)
+
+    def _get_dense_embedding(self, text: str) -> torch.Tensor:
+        """Get a normalized embedding for text by mean-pooling the model's input embedding rows"""
+        input_ids = self._encode(text)
+        input_ids = input_ids[~torch.isin(input_ids, self._special_ids)]
+        if len(input_ids) == 0:
             return None
 
-        # Tokenize and convert to tensor
-        inputs = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
-        input_ids = inputs["input_ids"]
-        
-        # Create a simple embedding by averaging token embeddings
-        # This is a basic approach - could be improved with actual model embeddings
         with torch.no_grad():
-            # Get token embeddings from the tokenizer's vocabulary
-            vocab_size = len(self.tokenizer.get_vocab())
-            # Create a one-hot encoding of the tokens
-            embedding = torch.zeros(vocab_size, dtype=torch.float)
-            for id in input_ids[0]:
-                embedding[id.item()] = 1.0
-            # Normalize the embedding
-            embedding = F.normalize(embedding, p=2, dim=0)
-            return embedding
+            rows = self.input_embeddings[input_ids.to(self.input_embeddings.device)]
+            pooled = rows.float().mean(dim=0).cpu()
+        return F.normalize(pooled - self._embedding_center, p=2, dim=0)
+
+    def _get_cached_dense_embedding(self, text: str) -> torch.Tensor:
+        """Dense document embedding, computed once per model and document text and kept on disk"""
+        path = os.path.join(self._embedding_cache_dir, hashlib.sha256(text.encode("utf-8")).hexdigest() + ".pt")
+        if os.path.exists(path):
+            try:
+                return torch.load(path, weights_only=True)
+            except Exception as e:
+                print(f"Could not read cached embedding {path}: {e}")
+
+        embedding = self._get_dense_embedding(text)
+        if embedding is not None:
+            try:
+                os.makedirs(self._embedding_cache_dir, exist_ok=True)
+                # Write to a file private to this call and rename, so concurrent sessions never read a partial file
+                fd, partial_path = tempfile.mkstemp(suffix=".partial", dir=self._embedding_cache_dir)
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        torch.save(embedding, f)
+                    os.replace(partial_path, path)
+                except BaseException:
+                    os.remove(partial_path)
+                    raise
+            except OSError as e:
+                print(f"Could not cache embedding: {e}")
+        return embedding
 
     def add_documents(self, documents: List[Document]):
-        """Add documents and create embeddings"""
+        """Add documents and create embeddings - ones already added are skipped"""
+        discovered_bits, added = self._discovered_bits, self._added
         for doc in documents:
-            self.documents[doc.id] = doc
-
-            # Create document text for embedding
-            doc_text = f"{doc.title} {doc.content}"
-
-            if self.tokenizer:
-                # Use TinyLLaMA tokenizer for embedding
-                embedding = self._get_embedding(doc_text)
-                if embedding is not None:
-                    self.document_embeddings[doc.id] = embedding
-            else:
-                # Fallback: use keyword-based system
-                self.document_embeddings[doc.id] = doc_text.lower()
+            if self.case_index is not None and doc.id in self.case_index:
+                # Already embedded in the shared case index - discovering it just sets its bit
+                self._discovered_bits |= 1 << self.case_index.rows[doc.id]
+                continue
+            if doc.id in self.documents:
+                continue  # E.g. the solution, found again whenever the player names it
+
+            self._added += (doc,)
+            self._index_document(doc)
+
+        if self._discovered_bits != discovered_bits or self._added is not added:
+            self.discovery_version = next(self._versions)  # Cached contexts were built without these
+
+    def _index_document(self, doc: Document):
+        """Add a document outside the case index to this session's own indexes"""
+        self.documents[doc.id] = doc
+        self.passages[doc.id] = self._get_passages(doc)
+
+        # Create document text for embedding
+        doc_text = f"{doc.title} {doc.content}"
+        self.keyword_index.add(doc.id, doc_text)
+
+        if self.retrieval_mode == "dense":
+            embedding = self._get_cached_dense_embedding(doc_text)
+            if embedding is not None:
+                self.document_embeddings[doc.id] = embedding
+                self._write_row(doc.id, slice(0, self._num_columns), embedding)
+        elif self.retrieval_mode == "tokens" and self.tokenizer is not None:
+            # Use TinyLLaMA tokenizer for embedding
+            embedding = self._get_embedding(doc_text)
+            if embedding is not None:
+                self.document_embeddings[doc.id] = embedding
+                self._index_embedding(doc.id, embedding)
+
+    def snapshot(self) -> Tuple[int, Tuple[Document, ...], int]:
+        """The retrieval state, to hand back to restore() later - constant time"""
+        return self._discovered_bits, self._added, self.discovery_version
+
+    def restore(self, snapshot: Tuple[int, Tuple[Document, ...], int]):
+        """
+        Go back to a state from snapshot()
+
+        Case documents are only bits, so this is constant time unless the
+        documents added outside the case index differ - those (usually none,
+        or the solution) are indexed again.
+        """
+        discovered_bits, added, version = snapshot
+        self._discovered_bits = discovered_bits
+        if added is not self._added:
+            self._clear_own_index()
+            for doc in added:
+                self._index_document(doc)
+            self._added = added
+        self.discovery_version = version  # The same documents again, so contexts cached for it are still right
+
+    def reset(self):
+        """Forget every added document, keeping the shared case index and the query cache"""
+        self.restore((0, (), 0))
+
+    def _clear_own_index(self):
+        """Empty the indexes of documents added outside the case index"""
+        self.document_embeddings = {}
+        self.documents = {}
+        self.passages = {}
+        self.keyword_index = BM25Index()
+        # The matrix allocation is kept - rows are rewritten from scratch when reused
+        self._matrix_doc_ids = []
+        self._doc_rows = {}
+        if self.retrieval_mode != "dense":
+            self._token_columns = None
+            self._num_columns = 0
+
+    def _index_embedding(self, doc_id: str, embedding: SparseEmbedding):
+        """Write a document's embedding into its row of the retrieval matrix"""
+        if self._token_columns is None:
+            self._token_columns = torch.full((self.vocab_size,), -1, dtype=torch.long)
+        columns = self._token_columns[embedding.token_ids]
+        unseen = columns < 0
+        if unseen.any():
+            new_columns = torch.arange(self._num_columns, self._num_columns + int(unseen.sum()))
+            self._token_columns[embedding.token_ids[unseen]] = new_columns
+            columns[unseen] = new_columns
+            self._num_columns += len(new_columns)
+
+        self._write_row(doc_id, columns, embedding.weights)
+
+    def _write_row(self, doc_id: str, columns, values: torch.Tensor):
+        """Store a document's vector in its row of the retrieval matrix"""
+        row = self._doc_rows.get(doc_id)
+        if row is None:  # Re-adding a document (e.g. the solution) overwrites its row
+            row = len(self._matrix_doc_ids)
+            self._doc_rows[doc_id] = row
+            self._matrix_doc_ids.append(doc_id)
+
+        self._reserve(row + 1, self._num_columns)
+        self._doc_matrix[row].zero_()
+        self._doc_matrix[row, columns] = values
+
+    def _reserve(self, num_rows: int, num_columns: int):
+        """Make room in the retrieval matrix, doubling each dimension that runs out"""
+        rows, cols = self._doc_matrix.shape
+        if num_rows <= rows and num_columns <= cols:
+            return
+        grown = torch.zeros(
+            max(num_rows, 2 * rows) if num_rows > rows else rows,
+            max(num_columns, 2 * cols) if num_columns > cols else cols
+        )
+        grown[:rows, :cols] = self._doc_matrix
+        self._doc_matrix = grown
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Collapse whitespace, so trivially different spellings of a question share cache entries"""
+        return " ".join(query.split())
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit/miss counters of the query embedding and context caches"""
+        return {"query": self._query_cache.stats(), "context": self._context_cache.stats()}
 
     def retrieve_relevant_documents(self, query: str, top_k: int = 3) -> List[Tuple[Document, float]]:
         """Retrieve the most relevant documents for a query"""
-        if not self.documents:
+        if not self.documents and not self._discovered_bits:
             return []
+        query = self.normalize_query(query)
 
-        if self.tokenizer:
-            return self._semantic_retrieval(query, top_k)
-        else:
+        if self.retrieval_mode == "bm25" or self.tokenizer is None:
             return self._keyword_retrieval(query, top_k)
+        else:
+            return self._semantic_retrieval(query, top_k)
 
     def _semantic_retrieval(self, query: str, top_k: int) -> List[Tuple[Document, float]]:
-        """Semantic retrieval using PyTorch functional cosine similarity"""
-        query_embedding = self._get_embedding(query)
-        if query_embedding is None:
-            return self._keyword_retrieval(query, top_k)
-
-        similarities = []
-        for doc_id, doc_embedding in self.document_embeddings.items():
-            # Calculate cosine similarity using PyTorch functional
-            similarity = F.cosine_similarity(
-                query_embedding.unsqueeze(0),
-                doc_embedding.unsqueeze(0)
-            ).item()
-            similarities.append((doc_id, similarity))
-
-        # Sort by similarity and get top_k
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        """Semantic retrieval - cosine similarity of the query against every document row at once"""
+        query_embedding = self._get_query_embedding(query)
+        if query_embedding is None:  # Nothing left to embed, e.g. an empty query
+            return []
 
         results = []
-        for doc_id, score in similarities[:top_k]:
-            if score > 0.1:  # Minimum similarity threshold
-                results.append((self.documents[doc_id], score))
+        num_docs = len(self._matrix_doc_ids)
+        if num_docs:
+            similarities = self._doc_matrix[:num_docs, :self._num_columns] @ self._get_query_vector(query_embedding)
+            scores, rows = torch.topk(similarities, min(top_k, num_docs))
+            keep = scores > self.MIN_SIMILARITY
+            results += [(self._matrix_doc_ids[row], score) for row, score in zip(rows[keep].tolist(), scores[keep].tolist())]
+        if self.case_index is not None:
+            results += self.case_index.search(
+                self._get_case_index_query_vector(query_embedding), self._discovered_mask(), top_k, self.MIN_SIMILARITY
+            )
 
-        return results
+        return self._best(results, top_k)
+
+    def _get_query_embedding(self, query: str):
+        """Embedding of a (normalized) query, from the cache when it was asked before"""
+        embedding = self._query_cache.get(query)
+        if embedding is None:
+            embedding = self._get_dense_embedding(query) if self.retrieval_mode == "dense" else self._get_embedding(query)
+            self._query_cache.put(query, embedding)  # Never modified afterwards, so safe to share
+        return embedding
+
+    def _discovered_mask(self) -> np.ndarray:
+        """Boolean mask of the discovered case index rows, unpacked from the bitset when it changed"""
+        if self._mask_bits != self._discovered_bits:
+            num_docs = len(self.case_index)
+            packed = np.frombuffer(self._discovered_bits.to_bytes((num_docs + 7) // 8, "little"), dtype=np.uint8)
+            self._mask = np.unpackbits(packed, count=num_docs, bitorder="little").astype(bool)
+            self._mask_bits = self._discovered_bits
+        return self._mask
+
+    def _get_query_vector(self, query_embedding) -> torch.Tensor:
+        """Put the query embedding in the retrieval matrix's column space"""
+        if self.retrieval_mode == "dense":
+            return query_embedding
+
+        # Project the query onto the document columns - tokens no document contains score zero anyway
+        query_vector = torch.zeros(self._num_columns)
+        columns = self._token_columns[query_embedding.token_ids]
+        known = columns >= 0
+        query_vector[columns[known]] = query_embedding.weights[known]
+        return query_vector
+
+    def _get_case_index_query_vector(self, query_embedding) -> np.ndarray:
+        """Put the query embedding in the case index's column space"""
+        if self.retrieval_mode == "dense":
+            return query_embedding.numpy()
+
+        query_vector = np.zeros(self.case_index.vectors.shape[1], dtype=np.float32)
+        columns = self.case_index.token_columns[query_embedding.token_ids.numpy()]
+        known = columns >= 0
+        query_vector[columns[known]] = query_embedding.weights.numpy()[known]
+        return query_vector
 
     def _keyword_retrieval(self, query: str, top_k: int) -> List[Tuple[Document, float]]:
-        """Fallback keyword-based retrieval"""
-        query_lower = query.lower()
-        query_words = set(query_lower.split())
-
-        scores = []
-        for doc_id, doc_text in self.document_embeddings.items():
-            doc_words = set(doc_text.split())
-            overlap = len(query_words.intersection(doc_words))
-            if overlap > 0:
-                score = overlap / len(query_words.union(doc_words))
-                scores.append((doc_id, score))
-
-        scores.sort(key=lambda x: x[1], reverse=True)
-
-        results = []
-        for doc_id, score in scores[:top_k]:
-            results.append((self.documents[doc_id], score))
-
-        return results
-
-    def create_context_for_prompt(self, query: str, max_context_length: int = 500) -> str:
-        """Create context string from relevant documents for the LLM prompt"""
+        """Keyword retrieval - BM25 over the inverted index"""
+        if self.case_index is None:
+            return self._best(self.keyword_index.search(query, top_k), top_k)
+
+        # Discovered documents are split between the case index and our own index -
+        # weight terms by the statistics of both, so scores match a single index
+        terms = BM25Index.tokenize(query)
+        num_docs, total_length, document_frequencies = self.keyword_index.statistics(set(terms))
+        mask = self._discovered_mask()
+        index_docs, index_length, index_frequencies = self.case_index.bm25_statistics(set(terms), mask)
+        statistics = (
+            num_docs + index_docs,
+            total_length + index_length,
+            {term: count + index_frequencies[term] for term, count in document_frequencies.items()}
+        )
+
+        results = self.keyword_index.search(query, top_k, statistics)
+        results += self.case_index.bm25_search(
+            terms, mask, top_k, self.keyword_index.k1, self.keyword_index.b, statistics
+        )
+        return self._best(results, top_k)
+
+    def _best(self, results: List[Tuple[str, float]], top_k: int) -> List[Tuple[Document, float]]:
+        """Merge (doc id, score) candidates into the `top_k` best documents"""
+        return [(self._document(doc_id), score) for doc_id, score in heapq.nlargest(top_k, results, key=lambda r: r[1])]
+
+    def _document(self, doc_id: str) -> Document:
+        """An added or discovered case document by id"""
+        doc = self.documents.get(doc_id)
+        return doc if doc is not None else self._case_documents[self.case_index.rows[doc_id]]
+
+    def _passages_of(self, doc_id: str) -> Tuple[str, int, Tuple[Passage, ...]]:
+        """(header, header tokens, passages) of an added or discovered case document"""
+        passages = self.passages.get(doc_id)
+        return passages if passages is not None else self._case_passages[self.case_index.rows[doc_id]]
+
+    def _count_tokens(self, text: str) -> int:
+        """Tokens text takes up in the prompt (estimated from its length without a tokenizer)"""
+        if self.tokenizer is None:
+            return math.ceil(len(text) / config.MIN_CHARS_PER_TOKEN)
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def prepare_passages(self, documents: List[Document], fingerprint: str = None):
+        """
+        Split and count tokens for documents ahead of time, e.g. when a case loads
+
+        Args:
+            documents: Documents to prepare
+            fingerprint: Precomputed hash of the documents (CaseData.fingerprint) - when given,
+                a set of documents already prepared in this process is skipped without looking at each one
+        """
+        self._get_case_passages(documents, fingerprint)
+
+    def _get_case_passages(self, documents: List[Document], fingerprint: str = None) -> Tuple[tuple, ...]:
+        """Passages of every document, in order - built once per process for a fingerprinted case"""
+        key = (getattr(self.tokenizer, "name_or_path", None), config.RAG_PASSAGE_MAX_TOKENS, fingerprint)
+        case_passages = _case_passages.get(key) if fingerprint is not None else None
+        if case_passages is None:
+            case_passages = tuple(self._get_passages(doc) for doc in documents)
+            if fingerprint is not None:
+                _case_passages[key] = case_passages
+        return case_passages
+
+    def _get_passages(self, doc: Document) -> Tuple[str, int, Tuple[Passage, ...]]:
+        """A document's context header and passages, split and token-counted once per process"""
+        key = (
+            getattr(self.tokenizer, "name_or_path", None),
+            config.RAG_PASSAGE_MAX_TOKENS,
+            doc.id,
+            hashlib.sha256(f"{doc.category}\0{doc.title}\0{doc.content}".encode("utf-8")).hexdigest()
+        )
+        chunks = _passage_cache.get(key)
+        if chunks is None:
+            header = f"\n[{doc.category.upper()}] {doc.title}:"
+            chunks = (header, self._count_tokens(header), self._split_passages(doc))
+            _passage_cache[key] = chunks
+        return chunks
+
+    def _split_passages(self, doc: Document) -> Tuple[Passage, ...]:
+        """Group a document's lines (or sentences, for long lines) into passages of limited token length"""
+        max_tokens = config.RAG_PASSAGE_MAX_TOKENS
+        pieces = []
+        for line in doc.content.splitlines():
+            line = " ".join(line.split())
+            if not line:
+                continue
+            if self._count_tokens(line) <= max_tokens:
+                pieces.append(line)
+            else:
+                # A sentence longer than the limit becomes a passage by itself
+                pieces.extend(sentence for sentence in re.split(r"(?<=[.!?…])\s+", line) if sentence)
+
+        passages = []
+        current = []
+        for piece in pieces:
+            if current and self._count_tokens(" ".join(current + [piece])) > max_tokens:
+                passages.append(" ".join(current))
+                current = []
+            current.append(piece)
+        if current:
+            # Fold a short tail (e.g. a closing "thank you") into the passage before it
+            if passages and self._count_tokens(" ".join(current)) < max_tokens // 4:
+                passages[-1] += " " + " ".join(current)
+            else:
+                passages.append(" ".join(current))
+
+        return tuple(
+            Passage(doc.id, index, text, self._count_tokens(" " + text), frozenset(BM25Index.tokenize(text)))
+            for index, text in enumerate(passages)
+        )
+
+    def create_context_for_prompt(self, query: str, max_context_tokens: int = None) -> str:
+        """
+        Create context string from relevant documents for the LLM prompt
+
+        Passages of the retrieved documents are packed greedily, best first,
+        until the token budget is used up - a long document can't crowd out
+        the rest, and the prompt length stays bounded.
+
+        Args:
+            query: The player's input
+            max_context_tokens: Token budget for the whole context - defaults to config.RAG_CONTEXT_MAX_TOKENS
+
+        Returns:
+            Context block for the prompt, or "" if nothing relevant fits
+        """
+        query = self.normalize_query(query)
+        max_context_tokens = max_context_tokens or config.RAG_CONTEXT_MAX_TOKENS
+        # The context only changes when documents are discovered
+        cache_key = (query, self.discovery_version, max_context_tokens)
+        context = self._context_cache.get(cache_key)
+        if context is None:
+            context = self._build_context(query, max_context_tokens)
+            self._context_cache.put(cache_key, context)
+        return context
+
+    def _build_context(self, query: str, max_context_tokens: int) -> str:
+        """Pack the passages of the documents retrieved for query into max_context_tokens"""
         relevant_docs = self.retrieve_relevant_documents(query)
-
         if not relevant_docs:
             return ""
 
-        context_parts = ["DISCOVERED CLUES AND EVIDENCE:"]
-        current_length = len(context_parts[0])
-
-        for doc, score in relevant_docs:
-            doc_text = f"\n[{doc.category.upper()}] {doc.title}: {doc.content}"
-
-            if current_length + len(doc_text) > max_context_length:
-                break
+        title = "DISCOVERED CLUES AND EVIDENCE:"
+        budget = max_context_tokens - self._count_tokens(title)
+
+        # A passage ranks by its document's score, boosted by how many query words it contains
+        query_terms = set(BM25Index.tokenize(query))
+        candidates = []
+        for rank, (doc, score) in enumerate(relevant_docs):
+            for passage in self._passages_of(doc.id)[2]:
+                matched = len(query_terms & passage.terms) / len(query_terms) if query_terms else 0.0
+                candidates.append((score * (1 + matched), -rank, -passage.index, passage))
+        candidates.sort(key=lambda candidate: candidate[:3], reverse=True)
+
+        chosen = {}  # Document id -> passages
+        for _, _, _, passage in candidates:
+            cost = passage.token_count
+            if passage.doc_id not in chosen:
+                cost += self._passages_of(passage.doc_id)[1]
+            if cost <= budget:
+                chosen.setdefault(passage.doc_id, []).append(passage)
+                budget -= cost
+
+        if not chosen:
+            return ""
 
+        context_parts = [title]
+        for doc, _ in relevant_docs:
+            if doc.id not in chosen:
+                continue
+            doc_text = self._passages_of(doc.id)[0]
+            previous = None
+            for passage in sorted(chosen[doc.id], key=lambda p: p.index):
+                # Mark where passages were skipped
+                doc_text += " ..." if previous is not None and passage.index != previous + 1 else ""
+                doc_text += " " + passage.text
+                previous = passage.index
             context_parts.append(doc_text)
-            current_length += len(doc_text)
 
-        return "\n".join(context_parts)
\ No newline at end of file
+        return "\n".join(context_parts)
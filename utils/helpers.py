@@ -6,6 +6,8 @@ import json
 import os
 from datetime import datetime
 
+import config
+
 
 def save_conversation(conversation_history, case_name):
     """Save conversation history to file"""
@@ -20,10 +22,10 @@ def save_conversation(conversation_history, case_name):
 
 def load_case_data(case_name):
     """Load case data from file"""
-    filename = f"data/cases/{case_name}.json"
+    filename = os.path.join(config.CASE_DATA_PATH, f"{case_name}.json")
 
     if os.path.exists(filename):
-        with open(filename, 'r') as f:
+        with open(filename, 'r', encoding='utf-8') as f:
             return json.load(f)
     return None
 
@@ -36,4 +38,29 @@ def format_conversation_for_display(conversation_history):
             formatted.append(("user", entry[7:]))  # Remove "Human: " prefix
         elif entry.startswith("Detective"):
             formatted.append(("assistant", entry[15:]))  # Remove "Detective Sam: " prefix
-    return formatted
\ No newline at end of file
+    return formatted
+
+
+class ViewCache:
+    """Derived views (summaries, lists, ...) rebuilt only when the state version they came from changes"""
+
+    def __init__(self):
+        self._views = {}  # View name -> (version, value)
+
+    def get(self, name, version, build):
+        """
+        The view `name` for `version`, calling build() only if it wasn't built for that version yet
+
+        Args:
+            name: Which view
+            version: Anything that compares equal exactly when the underlying state is the same
+            build: Computes the view
+
+        Returns:
+            The cached or newly built value - shared, so don't modify it
+        """
+        cached = self._views.get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, build())
+            self._views[name] = cached
+        return cached[1]
@@ -0,0 +1,140 @@
+"""
+Multi-keyword matching for document discovery
+
+Every keyword of a case is compiled into one Aho-Corasick automaton, so a
+single pass over the text finds all of them - instead of one substring search
+per keyword.
+"""
+from collections import deque
+from typing import List, Set
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"  # "" (no character) is not
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over a fixed list of keywords"""
+
+    def __init__(self, keywords: List[str], whole_words: bool = False):
+        """
+        Compile the automaton
+
+        Args:
+            keywords: Keywords to look for, matched exactly (lower-case them first for case-insensitive matching)
+            whole_words: Only report keywords that aren't part of a longer word,
+                so "hugo" doesn't fire inside "hugonaut"
+        """
+        self.keywords = list(keywords)
+        self.whole_words = whole_words
+        self.max_keyword_length = max((len(keyword) for keyword in self.keywords), default=0)
+
+        # Trie of the keywords: state -> {char: next state}
+        self._goto = [{}]
+        self._outputs = [[]]  # State -> indices of the keywords ending there
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._outputs.append([])
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._outputs[state].append(index)
+
+        # Failure links: the longest proper suffix of a state that is also in the trie.
+        # Breadth-first, so a state's failure target is always finished before it
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # Keywords that are suffixes of this one end here too
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def find(self, text: str) -> Set[int]:
+        """Indices of every keyword occurring in text"""
+        scanner = self.scanner()
+        return set(scanner.feed(text)) | set(scanner.finish())
+
+    def scanner(self) -> "KeywordScanner":
+        """A resumable search, for text that arrives in pieces"""
+        return KeywordScanner(self)
+
+
+class KeywordScanner:
+    """
+    Matches an automaton's keywords against text fed in chunks
+
+    The automaton state carries over between chunks, so a keyword split across
+    a chunk boundary is still found, and no text is scanned twice. Each keyword
+    is reported once, the first time it occurs.
+    """
+
+    def __init__(self, automaton: KeywordAutomaton):
+        self.automaton = automaton
+        self.found = set()
+        self._state = 0
+        self._tail = ""  # The last characters seen - enough to look behind the longest keyword
+        self._tail_length = automaton.max_keyword_length + 1
+        self._pending = []  # Whole-word matches that end where the text so far ends
+
+    def feed(self, chunk: str) -> List[int]:
+        """Scan the next piece of text and return the indices of keywords found for the first time, in order"""
+        if not chunk:
+            return []
+        automaton = self.automaton
+        goto, fail, outputs = automaton._goto, automaton._fail, automaton._outputs
+        text = self._tail + chunk  # Positions below len(self._tail) were already scanned
+        newly_found = self._resolve_pending(chunk[:1])
+
+        state = self._state
+        for position in range(len(self._tail), len(text)):
+            char = text[position]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in outputs[state]:
+                if index in self.found:
+                    continue
+                if automaton.whole_words:
+                    keyword = automaton.keywords[index]
+                    start = position - len(keyword) + 1
+                    if _is_word_char(keyword[0]) and start > 0 and _is_word_char(text[start - 1]):
+                        continue
+                    if _is_word_char(keyword[-1]):
+                        if position + 1 == len(text):
+                            # The next character decides - it is in the next chunk
+                            self._pending.append(index)
+                            continue
+                        if _is_word_char(text[position + 1]):
+                            continue
+                self.found.add(index)
+                newly_found.append(index)
+
+        self._state = state
+        self._tail = text[-self._tail_length:]
+        return newly_found
+
+    def finish(self) -> List[int]:
+        """End of text - keywords that were waiting for their next character count as whole words"""
+        return self._resolve_pending("")
+
+    def _resolve_pending(self, next_char: str) -> List[int]:
+        """Settle whole-word matches that ended the text so far, now that the next character ("" = none) is known"""
+        pending, self._pending = self._pending, []
+        if _is_word_char(next_char):
+            return []
+        resolved = [index for index in pending if index not in self.found]
+        self.found.update(resolved)
+        return resolved
@@ -0,0 +1,23 @@
+"""
+Level-gated logging for the game's hot paths
+
+Messages below config.LOG_LEVEL are dropped after a single level check, and
+their %-style arguments are never formatted.
+"""
+import logging
+import sys
+
+import config
+
+_root = logging.getLogger("detective")
+if not _root.handlers:
+    _handler = logging.StreamHandler(sys.stdout)  # Alongside the print output, as before
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _root.addHandler(_handler)
+    _root.setLevel(config.LOG_LEVEL)
+    _root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for one part of the game, e.g. get_logger("discovery")"""
+    return _root.getChild(name)
@@ -0,0 +1,51 @@
+"""
+Process-wide tokenizer cache
+
+Loading a tokenizer takes a noticeable fraction of a second (and may hit the
+Hugging Face Hub), so each one is loaded once per process and shared by the
+model, every case and every session.
+
+Shared fast tokenizers should only be called without per-call truncation or
+padding options: those reconfigure the underlying Rust tokenizer, which can
+race with another session encoding at the same time. Anything a tokenizer
+needs set up (like a pad token) is done here, before it is shared.
+"""
+import threading
+import weakref
+
+from transformers import AutoTokenizer
+
+_tokenizers = {}  # Name or path -> tokenizer
+_vocab_sizes = weakref.WeakKeyDictionary()  # Tokenizer -> vocabulary size
+_lock = threading.Lock()
+
+
+def get_tokenizer(name_or_path: str):
+    """
+    The tokenizer for a model name or local path, loaded on first use
+
+    Args:
+        name_or_path: Hugging Face Hub id or local directory
+
+    Returns:
+        The shared tokenizer, with a pad token (EOS if it had none) - don't reconfigure it
+    """
+    with _lock:
+        tokenizer = _tokenizers.get(name_or_path)
+        if tokenizer is None:
+            tokenizer = AutoTokenizer.from_pretrained(name_or_path)
+            # Batched generation pads with it - set once, before any session sees the tokenizer
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            _tokenizers[name_or_path] = tokenizer
+        return tokenizer
+
+
+def vocab_size(tokenizer) -> int:
+    """Size of the tokenizer's vocabulary, added tokens included - computed once per tokenizer"""
+    size = _vocab_sizes.get(tokenizer)
+    if size is None:
+        # get_vocab() builds a fresh dict on every call, so only ask once
+        size = len(tokenizer.get_vocab())
+        _vocab_sizes[tokenizer] = size
+    return size